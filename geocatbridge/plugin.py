@@ -13,6 +13,7 @@ from .utils.files import removeTempFolder
 from .ui.bridgedialog import BridgeDialog
 from .ui.multistylerdialog import MultistylerDialog
 from .publish.servers import readServers
+from .publish.serverbase import watchAuthManager, unwatchAuthManager
 from .processing.bridgeprovider import BridgeProvider
 from .errorhandler import handleError
 
@@ -63,6 +64,8 @@ class GeocatBridge:
 
 
     def initGui(self):
+        watchAuthManager()
+
         iconPublish = QIcon(os.path.join(os.path.dirname(__file__), "icons", "publish_button.png"))
         self.actionPublish = QAction(iconPublish, QCoreApplication.translate("GeocatBridge", "Publish"), self.iface.mainWindow())
         self.actionPublish.setObjectName("startPublish")
@@ -96,6 +99,8 @@ class GeocatBridge:
     def unload(self):
 
         removeTempFolder()                        
+
+        unwatchAuthManager()
     
         self.iface.currentLayerChanged.disconnect(self.multistylerDialog.updateForCurrentLayer)
 
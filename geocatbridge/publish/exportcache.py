@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+
+from qgis.PyQt.QtCore import QSettings, QStandardPaths
+from qgis.core import QgsFields
+
+from geocatbridge.utils.files import tempFilenameInTempFolder
+from .manifest import sourceFiles
+
+CACHE_SIZE_SETTING = "geocatbridge/ExportCacheSize"
+DEFAULT_CACHE_SIZE = 10240
+# entries used recently might still be in use (being uploaded, for
+# instance), so they are not evicted
+MIN_ENTRY_AGE = 600
+
+_evictionLock = threading.Lock()
+
+def cacheFolder():
+    folder = os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation),
+                          "geocatbridge", "exports")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def cacheSize():
+    try:
+        return max(0, int(QSettings().value(CACHE_SIZE_SETTING, DEFAULT_CACHE_SIZE))) * 1024 * 1024
+    except (TypeError, ValueError):
+        return DEFAULT_CACHE_SIZE * 1024 * 1024
+
+def _cacheKey(layer, filename, fields, options):
+    files = sourceFiles(layer)
+    if not files:
+        return None
+    if layer.type() == layer.VectorLayer:
+        if layer.isModified():
+            # unsaved edits are exported too, but are not in the source files
+            return None
+        layerFields = layer.fields()
+        for i in range(layerFields.count()):
+            # neither are virtual or joined fields
+            if ((not fields or layerFields.at(i).name() in fields)
+                    and layerFields.fieldOrigin(i) != QgsFields.OriginProvider):
+                return None
+        subset = layer.subsetString()
+    else:
+        subset = ""
+    crs = layer.crs()
+    values = {"source": layer.source(),
+              "files": [(f, os.path.getmtime(f), os.path.getsize(f)) for f in files],
+              "subset": subset,
+              "fields": sorted(fields or []),
+              "filename": filename,
+              "crs": crs.authid() or crs.toWkt(),
+              "options": options}
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+def cachedExport(layer, filename, fields, write, options=None):
+    # Returns the path to an export of the layer, and whether it was taken
+    # from the cache. write(path) does the actual export. Layers that do not
+    # come from local files are exported to a temp folder, as usual
+    maxSize = cacheSize()
+    key = _cacheKey(layer, filename, fields, options) if maxSize else None
+    if key is None:
+        output = tempFilenameInTempFolder(filename)
+        write(output)
+        return output, False
+    folder = os.path.join(cacheFolder(), key)
+    output = os.path.join(folder, filename)
+    if os.path.exists(output):
+        os.utime(folder)
+        return output, True
+    # the export is written to its own folder and only then moved into
+    # place, so an entry is never seen incomplete
+    partial = "%s.%s.partial" % (folder, uuid.uuid4().hex)
+    os.makedirs(partial)
+    try:
+        write(os.path.join(partial, filename))
+    except:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    try:
+        os.rename(partial, folder)
+    except OSError:
+        # the same export was cached meanwhile by another thread
+        shutil.rmtree(partial, ignore_errors=True)
+    os.utime(folder)
+    evict(maxSize)
+    return output, False
+
+def _folderSize(folder):
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+def evict(maxSize=None, root=None):
+    # Least recently used entries of a cache folder are removed until it
+    # fits in maxSize. Entries are either folders or single files
+    maxSize = cacheSize() if maxSize is None else maxSize
+    with _evictionLock:
+        root = root or cacheFolder()
+        entries = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.endswith(".partial"):
+                continue
+            try:
+                if os.path.isdir(path):
+                    entries.append((os.path.getmtime(path), _folderSize(path), path))
+                else:
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+        total = sum(e[1] for e in entries)
+        now = time.time()
+        for lastUsed, size, path in sorted(entries):
+            if total <= maxSize:
+                break
+            if now - lastUsed < MIN_ENTRY_AGE:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+def clearCache():
+    with _evictionLock:
+        shutil.rmtree(cacheFolder(), ignore_errors=True)
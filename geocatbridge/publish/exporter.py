@@ -1,15 +1,216 @@
 import os
+import shutil
 import gdal
 
-from qgis.core import QgsVectorFileWriter, QgsRasterFileWriter
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsVectorFileWriter, QgsRasterFileWriter, QgsFields, QgsProviderRegistry,
+                       QgsCoordinateReferenceSystem)
+from qgis.PyQt.QtCore import QCoreApplication, QSettings
 
-from geocatbridge.utils.files import tempFilenameInTempFolder
+from .exportcache import cachedExport
 
 def isSingleTableGpkg(layer):
     ds = gdal.OpenEx(layer)
     return ds.GetLayerCount() == 1
 
+TRANSACTION_SIZE = 100000
+RASTER_COG_SETTING = "geocatbridge/RasterExportCog"
+RASTER_COMPRESSION_SETTING = "geocatbridge/RasterCompression"
+DEFAULT_RASTER_COMPRESSION = "DEFLATE"
+RASTER_BLOCK_SIZE_SETTING = "geocatbridge/RasterBlockSize"
+DEFAULT_RASTER_BLOCK_SIZE = 512
+OVERVIEW_MIN_SIZE = 256
+PASS_THROUGH_TYPES = [gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16, gdal.GDT_UInt32,
+                      gdal.GDT_Int32, gdal.GDT_Float32, gdal.GDT_Float64]
+
+def rasterExportOptions():
+    try:
+        blockSize = int(QSettings().value(RASTER_BLOCK_SIZE_SETTING, DEFAULT_RASTER_BLOCK_SIZE))
+    except (TypeError, ValueError):
+        blockSize = DEFAULT_RASTER_BLOCK_SIZE
+    return {"cog": str(QSettings().value(RASTER_COG_SETTING, True)).lower() not in ["false", "0"],
+            "compression": QSettings().value(RASTER_COMPRESSION_SETTING, DEFAULT_RASTER_COMPRESSION),
+            "blocksize": blockSize}
+
+def _canTranslate(layer, fields):
+    # GDAL can only translate what is in the source file itself, so layers
+    # with unsaved edits, virtual or joined fields, a SQL subset, a geometry
+    # type filter or open options are exported by QGIS
+    if layer.providerType() != "ogr" or layer.isModified():
+        return False
+    parts = QgsProviderRegistry.instance().decodeUri("ogr", layer.source())
+    if not os.path.isfile(parts.get("path", "")):
+        return False
+    if parts.get("geometryType") or parts.get("openOptions"):
+        return False
+    if layer.subsetString().strip().lower().startswith("select"):
+        return False
+    layerFields = layer.fields()
+    for i in range(layerFields.count()):
+        if ((not fields or layerFields.at(i).name() in fields)
+                and layerFields.fieldOrigin(i) != QgsFields.OriginProvider):
+            return False
+    return True
+
+def _translate(layer, output, driverName, fields):
+    parts = QgsProviderRegistry.instance().decodeUri("ogr", layer.source())
+    src = gdal.OpenEx(parts["path"], gdal.OF_VECTOR)
+    if src is None:
+        return False
+    if parts.get("layerName"):
+        srcLayer = parts["layerName"]
+    else:
+        srcLayer = src.GetLayer(parts.get("layerId") or 0).GetName()
+    # the spatial index is built by the drivers once all features are written
+    options = ["-f", driverName, "-overwrite", "-nln", os.path.splitext(os.path.basename(output))[0],
+               "-gt", str(TRANSACTION_SIZE), "-a_srs", layer.crs().toWkt()]
+    if driverName == "ESRI Shapefile":
+        options.extend(["-lco", "ENCODING=UTF-8"])
+    if fields and len(fields) != layer.fields().count():
+        options.extend(["-select", ",".join(f.name() for f in layer.fields() if f.name() in fields)])
+    if layer.subsetString():
+        options.extend(["-where", layer.subsetString()])
+    options.append(srcLayer)
+    try:
+        ds = gdal.VectorTranslate(output, src, options=options)
+    except Exception:
+        ds = None
+    if ds is None:
+        return False
+    del ds
+    return True
+
+def _writeVector(layer, output, driverName, fields, attrs):
+    if _canTranslate(layer, fields) and _translate(layer, output, driverName, fields):
+        return
+    ret = QgsVectorFileWriter.writeAsVectorFormat(layer, output, "UTF-8", attributes=attrs, driverName=driverName)
+    # the writer reports failures with its return value, but a failed export
+    # must not be taken as a valid one, nor cached
+    error, message = ret[:2] if isinstance(ret, tuple) else (ret, "")
+    if error != QgsVectorFileWriter.NoError:
+        raise Exception(QCoreApplication.translate("GeocatBridge", "Cannot export layer {0}: {1}").format(layer.name(), message or error))
+
+def _writeRasterPipe(layer, writer):
+    error = writer.writeRaster(layer.pipe(), layer.width(), layer.height(), layer.extent(), layer.crs())
+    if error != QgsRasterFileWriter.NoError:
+        raise Exception(QCoreApplication.translate("GeocatBridge", "Cannot export layer {0}: {1}").format(layer.name(), error))
+
+def isCloudOptimized(filename):
+    # a COG, or at least a tiled and compressed GeoTIFF with overviews when
+    # it is big enough to need them
+    ds = gdal.Open(filename)
+    if ds is None or ds.GetDriver().ShortName != "GTiff":
+        return False
+    if ds.GetMetadataItem("LAYOUT", "IMAGE_STRUCTURE") == "COG":
+        return True
+    band = ds.GetRasterBand(1)
+    blockWidth, blockHeight = band.GetBlockSize()
+    tiled = blockWidth < ds.RasterXSize and blockWidth == blockHeight
+    compressed = ds.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE") is not None
+    small = max(ds.RasterXSize, ds.RasterYSize) <= OVERVIEW_MIN_SIZE * 2
+    return small or (tiled and compressed and band.GetOverviewCount() > 0)
+
+def canPassThrough(layer, options):
+    # The source GeoTIFF can be used as is if exporting it would produce the
+    # same pixels. Exports are written in raw mode, so the renderer does not
+    # matter, but the CRS set in QGIS and the no-data handling do. Sidecar
+    # files are ignored, since only the GeoTIFF itself is uploaded
+    filename = layer.source()
+    if layer.providerType() != "gdal" or not os.path.isfile(filename):
+        return False
+    ds = gdal.OpenEx(filename, gdal.OF_RASTER, sibling_files=[])
+    if ds is None or ds.GetDriver().ShortName != "GTiff":
+        return False
+    if ds.GetGeoTransform(can_return_null=True) is None:
+        return False
+    if QgsCoordinateReferenceSystem.fromWkt(ds.GetProjection()) != layer.crs():
+        return False
+    provider = layer.dataProvider()
+    for i in range(1, ds.RasterCount + 1):
+        if ds.GetRasterBand(i).DataType not in PASS_THROUGH_TYPES:
+            return False
+        if provider.userNoDataValues(i):
+            return False
+        if provider.sourceHasNoDataValue(i) and not provider.useSourceNoDataValue(i):
+            return False
+    del ds
+    return not options["cog"] or isCloudOptimized(filename)
+
+def _passThrough(layer, path, log):
+    filename = layer.source()
+    if path is None:
+        if log is not None:
+            log.logInfo(QCoreApplication.translate("GeocatBridge", "No need to export layer %s stored at %s") % (layer.name(), filename))
+        return filename
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(filename, path)
+    except OSError:
+        shutil.copyfile(filename, path)
+    if log is not None:
+        log.logInfo(QCoreApplication.translate("GeocatBridge", "Layer %s stored at %s copied to %s") % (layer.name(), filename, path))
+    return path
+
+def _overviewLevels(width, height):
+    levels = []
+    factor = 2
+    while max(width, height) / factor >= OVERVIEW_MIN_SIZE:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def _hasSourceNoData(layer):
+    # whether the no-data handling set in QGIS is the one in the source file
+    provider = layer.dataProvider()
+    for i in range(1, layer.bandCount() + 1):
+        if provider.userNoDataValues(i):
+            return False
+        if provider.sourceHasNoDataValue(i) and not provider.useSourceNoDataValue(i):
+            return False
+    return True
+
+def _writeRaster(layer, output, options):
+    compression = options["compression"]
+    blockSize = options["blocksize"]
+    filename = layer.source()
+    if (layer.providerType() == "gdal" and gdal.GetDriverByName("COG") is not None
+            and _hasSourceNoData(layer)):
+        try:
+            ds = gdal.Translate(output, filename, format="COG", outputSRS=layer.crs().toWkt(),
+                                creationOptions=["COMPRESS=%s" % compression, "BLOCKSIZE=%i" % blockSize,
+                                                 "OVERVIEWS=AUTO", "BIGTIFF=IF_SAFER"])
+        except Exception:
+            ds = None
+        if ds is not None:
+            del ds
+            return
+    writer = QgsRasterFileWriter(output)
+    writer.setOutputFormat("GTiff")
+    writer.setCreateOptions(["TILED=YES", "COMPRESS=%s" % compression, "BIGTIFF=IF_SAFER",
+                             "BLOCKXSIZE=%i" % blockSize, "BLOCKYSIZE=%i" % blockSize])
+    _writeRasterPipe(layer, writer)
+    del writer
+    ds = gdal.Open(output, gdal.GA_Update)
+    if ds is not None:
+        levels = _overviewLevels(ds.RasterXSize, ds.RasterYSize)
+        if levels:
+            ds.BuildOverviews("AVERAGE", levels)
+        del ds
+
+def _exportTo(layer, filename, fields, write, path, log, options=None):
+    if path is not None:
+        write(path)
+        output = path
+    else:
+        output, cached = cachedExport(layer, filename, fields, write, options)
+        if cached:
+            if log is not None:
+                log.logInfo(QCoreApplication.translate("GeocatBridge", "Reusing export of layer %s cached at %s") % (layer.name(), output))
+            return output
+    if log is not None:
+        log.logInfo(QCoreApplication.translate("GeocatBridge", "Layer %s exported to %s") % (layer.name(), output))
+    return output
+
 def exportLayer(layer, fields=None, toShapefile=False, path=None, force=False, log=None):
     filename = layer.source().split("|")[0]
     destFilename = layer.name()
@@ -18,39 +219,32 @@ def exportLayer(layer, fields=None, toShapefile=False, path=None, force=False, l
         if toShapefile:
             if force or layer.fields().count() != len(fields) or (os.path.splitext(filename.lower())[1]  != ".shp"):
                 attrs = [i for i, f in enumerate(layer.fields()) if len(fields) == 0 or f.name() in fields]
-                output = path or tempFilenameInTempFolder(destFilename + ".shp")
-                QgsVectorFileWriter.writeAsVectorFormat(layer, output, "UTF-8", attributes=attrs, driverName="ESRI Shapefile")
-                if log is not None:
-                    log.logInfo(QCoreApplication.translate("GeocatBridge", "Layer %s exported to %s") % (destFilename, output))
-                return output
+                def _write(output):
+                    _writeVector(layer, output, "ESRI Shapefile", fields, attrs)
+                return _exportTo(layer, destFilename + ".shp", fields, _write, path, log)
         elif (force or os.path.splitext(filename.lower())[1]  != ".gpkg"
                         or layer.fields().count() != len(fields) or not isSingleTableGpkg(filename)):
             attrs = [i for i, f in enumerate(layer.fields()) if len(fields) == 0 or f.name() in fields]
-            output = path or tempFilenameInTempFolder(destFilename + ".gpkg")
-            QgsVectorFileWriter.writeAsVectorFormat(layer, output, "UTF-8", attributes=attrs)
-            if log is not None:
-                log.logInfo(QCoreApplication.translate("GeocatBridge", "Layer %s exported to %s") % (destFilename, output))
-            return output
+            def _write(output):
+                _writeVector(layer, output, "GPKG", fields, attrs)
+            return _exportTo(layer, destFilename + ".gpkg", fields, _write, path, log)
         
         if log is not None:
             log.logInfo(QCoreApplication.translate("GeocatBridge", "No need to export layer %s stored at %s") % (destFilename, filename))
         return filename
     else:
-        if (force or not filename.lower().endswith("tif")):        
-            output = path or tempFilenameInTempFolder(destFilename + ".tif")
-            writer = QgsRasterFileWriter(output)
-            writer.setOutputFormat("GTiff");
-            writer.writeRaster(layer.pipe(), layer.width(), layer.height(), layer.extent(), layer.crs())
-            del writer
-            if log is not None:
-                log.logInfo(QCoreApplication.translate("GeocatBridge", "Layer %s exported to %s") % (destFilename, output))
-            return output
+        options = rasterExportOptions()
+        if canPassThrough(layer, options):
+            return _passThrough(layer, path, log)
         else:
-            if log is not None:
-                log.logInfo(QCoreApplication.translate("GeocatBridge", "No need to export layer %s stored at %s") % (destFilename, filename))
-            return filename
-
-
-
-
-
+            if options["cog"]:
+                def _write(output):
+                    _writeRaster(layer, output, options)
+            else:
+                options = None
+                def _write(output):
+                    writer = QgsRasterFileWriter(output)
+                    writer.setOutputFormat("GTiff");
+                    _writeRasterPipe(layer, writer)
+                    del writer
+            return _exportTo(layer, destFilename + ".tif", fields, _write, path, log, options)
@@ -1,5 +1,3 @@
-import requests
-
 from ..utils.gui import execute
 from .serverbase import ServerBase
 from .geoserver import GeoserverServer
@@ -31,7 +29,7 @@ class GeocatLiveServer(ServerBase):
     def _getUrls(self):
         def f():
             url = "%s/%s" % (self.BASE_URL, self.userid)
-            response = requests.get(url).json()
+            response = self.session().get(url).json()
             for serv in response["services"]:
                 if serv["application"] == "geoserver":
                     self._geoserverUrl = serv["url"] + "/rest"
@@ -65,8 +63,8 @@ class GeocatLiveServer(ServerBase):
     def setupForProject(self):
         self.geoserverServer().setupForProject()
     
-    def prepareForPublishing(self, onlySymbology):
-        self.geoserverServer().prepareForPublishing(onlySymbology)
+    def prepareForPublishing(self, onlySymbology, incremental=False):
+        self.geoserverServer().prepareForPublishing(onlySymbology, incremental)
 
     def closePublishing(self):
         self.geoserverServer().closePublishing()
@@ -102,6 +100,9 @@ class GeocatLiveServer(ServerBase):
     def layerExists(self, name):
         return self.geoserverServer().layerExists(name)
 
+    def layerNames(self):
+        return self.geoserverServer().layerNames()
+
     def deleteLayer(self, name):
         self.geoserverServer().deleteLayer(name)
     
@@ -117,9 +118,24 @@ class GeocatLiveServer(ServerBase):
     def publishLayerMetadata(self, layer, wms):
         return self.geonetworkServer().publishLayerMetadata(layer, wms)
 
+    def prepareForMetadataPublishing(self, incremental=False):
+        self.geonetworkServer().prepareForMetadataPublishing(incremental)
+
+    def layerMetadataMef(self, layer, wms):
+        return self.geonetworkServer().layerMetadataMef(layer, wms)
+
+    def metadataBatchSize(self):
+        return self.geonetworkServer().metadataBatchSize()
+
+    def publishMetadataBatch(self, records):
+        return self.geonetworkServer().publishMetadataBatch(records)
+
     def metadataExists(self, uuid):
         return self.geonetworkServer().metadataExists(uuid)
 
+    def existingMetadata(self, uuids):
+        return self.geonetworkServer().existingMetadata(uuids)
+
     def openMetadata(self, uuid):
         self.geonetworkServer().openMetadata(uuid)
 
@@ -142,4 +158,15 @@ class GeocatLiveServer(ServerBase):
         addServicesForGeodataServer("GeoCat Live Geoserver - " + self.userid, baseurl, self.geoserverAuthid)
 
     def validateBeforePublication(self, errors):
-        return self.geoserverServer().validateBeforePublication(errors)
\ No newline at end of file
+        return self.geoserverServer().validateBeforePublication(errors)
+
+    def setCancelCallback(self, callback):
+        super().setCancelCallback(callback)
+        for server in [self.geoserverServer(), self.geonetworkServer()]:
+            server.setCancelCallback(callback)
+
+    def closeSession(self):
+        super().closeSession()
+        for server in [self._geoserverServer, self._geonetworkServer]:
+            if server is not None:
+                server.closeSession()
\ No newline at end of file
@@ -1,4 +1,6 @@
 import os
+import json
+import threading
 import zipfile
 from xml.etree.ElementTree import Element, SubElement
 from xml.etree import ElementTree
@@ -7,10 +9,9 @@ from datetime import datetime
 import webbrowser
 
 import lxml.etree as ET
-import requests
 from requests.auth import HTTPBasicAuth
 
-from qgis.PyQt.QtCore import QSize, QCoreApplication
+from qgis.PyQt.QtCore import QSize, QCoreApplication, QSettings
 from qgis.PyQt.QtGui import QImage, QColor, QPainter
 from qgis.core import (
     QgsMessageLog, 
@@ -20,36 +21,102 @@ from qgis.core import (
     QgsMapRendererCustomPainterJob
 )
 
-from .metadata import saveMetadata
+from .metadata import metadataRecord, createMef, mergeMefs, uuidForLayer
+from .manifest import PublishManifest, metadataFingerprint, METADATA
 from ..utils.files import tempFilenameInTempFolder
-from .serverbase import ServerBase
+from .serverbase import ServerBase, createSession
 
+BATCH_SIZE_SETTING = "geocatbridge/MetadataBatchSize"
+DEFAULT_BATCH_SIZE = 50
+
+_managers = {}
+_managersLock = threading.Lock()
+
+def networkAccessManager(url, username, password):
+    # servers pointing to the same catalog with the same user share their
+    # session, and therefore the signin and the XSRF token
+    key = (url.strip("/"), username)
+    with _managersLock:
+        manager = _managers.get(key)
+        if manager is None or manager.password != password:
+            if manager is not None:
+                manager.close()
+            manager = _managers[key] = TokenNetworkAccessManager(url, username, password)
+        return manager
+
+def closeNetworkAccessManager(url, username):
+    with _managersLock:
+        manager = _managers.pop((url.strip("/"), username), None)
+    if manager is not None:
+        manager.close()
 
 class TokenNetworkAccessManager():
     def __init__(self, url, username, password):        
         self.url = url.strip("/")
+        self.username = username
+        self.password = password
         self.token = None
-        self.session = requests.Session()
-        self.session.auth = HTTPBasicAuth(username, password)
-    
+        self._session = None
+        self._signedIn = False
+        self._lock = threading.RLock()
+
+    @property
+    def session(self):
+        # created on first use, so servers that are never used cost nothing
+        with self._lock:
+            if self._session is None:
+                self._session = createSession()
+                self._session.auth = HTTPBasicAuth(self.username, self.password)
+            return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self.token = None
+            self._signedIn = False
+
     def setTokenInHeader(self):
-        if self.token is None:
-            self.getToken()
-        self.session.headers.update({"X-XSRF-TOKEN" : self.token}) 
+        # the token is obtained once and reused, until the catalog rejects it
+        with self._lock:
+            if not self._signedIn:
+                self.getToken()
+            return self.token
 
-    def request(self, url, data=None, method="get", headers={}):
+    def request(self, url, data=None, method="get", headers={}, **kwargs):
         QgsMessageLog.logMessage(QCoreApplication.translate("GeocatBridge", "Making '%s' request to '%s'") % (method, url), 'GeoCat Bridge', level=Qgis.Info)
-        self.setTokenInHeader()
-        method = getattr(self.session, method.lower())
-        resp = method(url, headers=headers, data=data)
+        token = self.setTokenInHeader()
+        resp = self._send(url, data, method, headers, token, **kwargs)
+        if resp.status_code == 403:
+            # the token has expired or the session was dropped by the catalog
+            self.invalidateToken(token)
+            resp = self._send(url, data, method, headers, self.setTokenInHeader(), **kwargs)
         resp.raise_for_status()
         return resp
 
+    def _send(self, url, data, method, headers, token, **kwargs):
+        headers = dict(headers)
+        if token is not None:
+            headers["X-XSRF-TOKEN"] = token
+        method = getattr(self.session, method.lower())
+        return method(url, headers=headers, data=data, **kwargs)
+
+    def invalidateToken(self, token):
+        # several threads may see the same token rejected, but only the
+        # first one has to sign in again
+        with self._lock:
+            if self.token == token:
+                self.token = None
+                self._signedIn = False
+
     def getToken(self):
-        signinUrl = self.url + '/eng/catalog.signin'
-        self.session.post(signinUrl)
-        self.token = self.session.cookies.get('XSRF-TOKEN')
-        self.session.headers.update({"X-XSRF-TOKEN" : self.token})
+        with self._lock:
+            signinUrl = self.url + '/eng/catalog.signin'
+            self.session.post(signinUrl)
+            self.token = self.session.cookies.get('XSRF-TOKEN')
+            self._signedIn = True
+            return self.token
 
 class GeonetworkServer(ServerBase):
 
@@ -66,16 +133,66 @@ class GeonetworkServer(ServerBase):
         self._isMetadataCatalog = True
         self._isDataCatalog = False 
         self.node = node
+        self._incremental = False
+        self._manifest = None
+        self._fingerprints = {}
+        self._fingerprintsLock = threading.Lock()
+
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = PublishManifest(self.url)
+        return self._manifest
+
+    def prepareForMetadataPublishing(self, incremental=False):
+        self._incremental = incremental
+        with self._fingerprintsLock:
+            self._fingerprints = {}
+
+    def networkAccessManager(self):
         user, password = self.getCredentials()
-        self._nam = TokenNetworkAccessManager(self.url, user, password)
+        return networkAccessManager(self.url, user, password)
 
+    def closeSession(self):
+        super().closeSession()
+        user, _ = self.getCredentials()
+        closeNetworkAccessManager(self.url, user)
 
     def request(self, url, data=None, method="get", headers={}):
-        return self._nam.request(url, data, method, headers)
+        return self.networkAccessManager().request(url, data, method, headers)
 
     def publishLayerMetadata(self, layer, wms):
-        mefFilename = saveMetadata(layer, None, self.apiUrl(), wms)            
-        self.publishMetadata(mefFilename)
+        mef = self.layerMetadataMef(layer, wms)
+        if mef is not None:
+            self.publishMetadata(mef)
+            self._setPublished([uuidForLayer(layer)])
+
+    def layerMetadataMef(self, layer, wms):
+        # returns None if the record has not changed since it was published
+        uuid, metadata, thumbnail = metadataRecord(layer, self.apiUrl(), wms)
+        name = layer.name()
+        fingerprint = metadataFingerprint(metadata, thumbnail)
+        if (self._incremental and self.manifest().isUnchanged(name, METADATA, fingerprint)
+                and self.metadataExists(uuid)):
+            self.logInfo(QCoreApplication.translate("GeocatBridge", "Metadata for layer %s has not changed. Skipping upload")
+                     % name)
+            return None
+        self.manifest().remove(name, METADATA)
+        with self._fingerprintsLock:
+            self._fingerprints[uuid] = (name, fingerprint)
+        return createMef(uuid, metadata, thumbnail)
+
+    def _setPublished(self, uuids):
+        with self._fingerprintsLock:
+            published = [self._fingerprints.pop(uuid) for uuid in uuids if uuid in self._fingerprints]
+        for name, fingerprint in published:
+            self.manifest().setFingerprint(name, METADATA, fingerprint)
+
+    def metadataBatchSize(self):
+        # records published together in a single MEF. 1 disables batching
+        try:
+            return max(1, int(QSettings().value(BATCH_SIZE_SETTING, DEFAULT_BATCH_SIZE)))
+        except (TypeError, ValueError):
+            return DEFAULT_BATCH_SIZE
 
     def testConnection(self):
         try:
@@ -101,16 +218,112 @@ class GeonetworkServer(ServerBase):
         url = self.apiUrl() + "/records/" + uuid
         return self.request(url)
 
+    def existingMetadata(self, uuids):
+        # Returns the subset of the given uuids that have a record in the
+        # catalog, using one search request instead of one request per record
+        uuids = list(uuids)
+        if not uuids:
+            return set()
+        try:
+            return self._existingMetadataFromIndex(uuids)
+        except Exception as e:
+            self.logInfo("Search API not available (%s). Using the legacy search service" % e)
+        try:
+            return self._existingMetadataFromLegacySearch(uuids)
+        except Exception as e:
+            self.logInfo("Legacy search service not available (%s). Checking records one by one" % e)
+        return {uuid for uuid in uuids if self.metadataExists(uuid)}
+
+    def _existingMetadataFromIndex(self, uuids):
+        url = self.apiUrl() + "/search/records/_search"
+        query = {"query": {"ids": {"values": uuids}}, 
+                 "_source": ["uuid"], 
+                 "size": len(uuids)}
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        r = self.request(url, json.dumps(query), "post", headers)
+        hits = r.json()["hits"]["hits"]
+        return {hit.get("_source", {}).get("uuid", hit.get("_id")) for hit in hits}
+
+    def _existingMetadataFromLegacySearch(self, uuids):
+        url = (self.xmlServicesUrl() + "/q?_content_type=json&fast=index&buildSummary=false&from=1&to=%i" 
+                % len(uuids))
+        r = self.request(url + "&_uuid=" + " or ".join(uuids))
+        records = r.json().get("metadata", [])
+        if isinstance(records, dict):
+            records = [records]
+        return {record["geonet:info"]["uuid"] for record in records}
+
     def publishMetadata(self, metadata):
-        self._nam.setTokenInHeader()
+        # metadata is the content of a MEF file
+        return self._postMef(metadata)
+
+    def _postMef(self, mef):
         url = self.apiUrl() + "/records"
         headers = {"Accept": "application/json"}
-        params = {"uuidProcessing", "OVERWRITE"}
+        params = {"uuidProcessing": "OVERWRITE"}
+
+        files = {'file': ("metadata.mef", mef)}
+        return self.networkAccessManager().request(url, method="post", headers=headers, 
+                                                   files=files, params=params)
+
+    def publishMetadataBatch(self, records):
+        # records maps uuids to MEF contents. They are all sent in a single
+        # MEF2 archive. Returns the error message of each record that could
+        # not be published, keyed by uuid
+        try:
+            r = self._postMef(mergeMefs(records.values()))
+        except Exception as e:
+            self.logInfo("Batch import of %i metadata records failed (%s). Publishing them one by one" 
+                         % (len(records), e))
+            failed = {}
+            for uuid, mef in records.items():
+                try:
+                    self._postMef(mef)
+                    self._setPublished([uuid])
+                except Exception as e:
+                    failed[uuid] = str(e)
+            return failed
+        try:
+            report = r.json()
+        except ValueError:
+            report = {}
+        failed = self._failedRecords(report, set(records.keys()))
+        self._setPublished([uuid for uuid in records if uuid not in failed])
+        return failed
 
-        with open(metadata, "rb") as f:
-            files = {'file': f}
-            r = self._nam.session.post(url, files=files, headers=headers)
-            r.raise_for_status()
+    def _failedRecords(self, report, uuids):
+        imported = set()
+        for infos in (report.get("metadataInfos") or {}).values():
+            for info in infos:
+                if isinstance(info, dict) and info.get("uuid") in uuids:
+                    imported.add(info["uuid"])
+        errors = list(report.get("errors") or [])
+        for metadataErrors in (report.get("metadataErrors") or {}).values():
+            errors.extend(metadataErrors)
+        failed = {}
+        unattributed = []
+        for error in errors:
+            if isinstance(error, dict):
+                message = error.get("message") or str(error)
+                uuid = error.get("uuid")
+            else:
+                message = str(error)
+                uuid = None
+            if uuid not in uuids:
+                uuid = next((u for u in uuids if u in message), None)
+            if uuid is None:
+                unattributed.append(message)
+            else:
+                failed[uuid] = message
+        # records not mentioned in the report are checked in the catalog
+        unresolved = uuids - imported - set(failed.keys())
+        if unresolved:
+            missing = unresolved - self.existingMetadata(unresolved)
+            message = "\n".join(unattributed) or QCoreApplication.translate("GeocatBridge", 
+                                                        "Metadata record was not imported")
+            for uuid in missing:
+                failed[uuid] = message
+        return failed
 
     def deleteMetadata(self, uuid):
         url = self.apiUrl() + "/records/" + uuid
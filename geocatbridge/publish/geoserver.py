@@ -2,31 +2,52 @@ import os
 import psycopg2
 import json
 import webbrowser
-from zipfile import ZipFile 
 import sqlite3
 import secrets
+import threading
+import time
+import ogr
 
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, HTTPError
 
 from qgis.core import QgsProject, QgsVectorLayer
 
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QCoreApplication, QSettings
 
 from bridgestyle.qgis import saveLayerStyleAsZippedSld
 
-from .exporter import exportLayer
-from .serverbase import ServerBase
+from .exporter import exportLayer, canPassThrough, rasterExportOptions
+from .serverbase import ServerBase, MAX_RETRIES, RETRY_DELAY
+from .manifest import PublishManifest, dataFingerprint, zipFingerprint, sourceFiles, DATA, STYLE, METADATA_LINK
 from ..utils.files import tempFilenameInTempFolder
 from ..utils.services import addServicesForGeodataServer
+from ..utils.concurrency import qgisLock
 
+RESUMABLE_THRESHOLD_SETTING = "geocatbridge/ResumableUploadThreshold"
+DEFAULT_RESUMABLE_THRESHOLD = 512 # MB
+RESUMABLE_CHUNK_SIZE = 16 * 1024 * 1024
+CATALOG_MAX_AGE = 30 # seconds
+
+WORKSPACE = "workspace"
+LAYER = "layer"
+STYLE_RESOURCE = "style"
+DATASTORE = "dataStore"
+COVERAGESTORE = "coverageStore"
+LAYERGROUP = "layerGroup"
+CATALOG_LISTINGS = {LAYER: "layers", STYLE_RESOURCE: "styles", DATASTORE: "datastores",
+                    COVERAGESTORE: "coveragestores", LAYERGROUP: "layergroups"}
+
+SHAPEFILE_SIZE_LIMIT = 2 * 1024 ** 3
+SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
 
 class GeoserverServer(ServerBase):
 
     FILE_BASED = 0
     POSTGIS_MANAGED_BY_BRIDGE = 1
     POSTGIS_MANAGED_BY_GEOSERVER = 2
+    SHARED_FOLDER = 3
 
-    def __init__(self, name, url="", authid="", storage=0, postgisdb=None):
+    def __init__(self, name, url="", authid="", storage=0, postgisdb=None, localPath="", serverPath=""):
         super().__init__()
         self.name = name
         
@@ -41,9 +62,22 @@ class GeoserverServer(ServerBase):
         self.authid = authid
         self.storage = storage
         self.postgisdb = postgisdb
+        self.localPath = localPath
+        self.serverPath = serverPath
         self._isMetadataCatalog = False
         self._isDataCatalog = True
-        self._layersCache = {}
+        self._catalog = None
+        self._catalogWorkspace = None
+        self._catalogTime = 0
+        self._catalogPinned = False
+        self._catalogLock = threading.RLock()
+        self._sourceLocks = {}
+        self._sourceLocksLock = threading.Lock()
+        self._datastoreLock = threading.Lock()
+        self._postgisDatastoreExists = False
+        self._incremental = False
+        self._unchangedData = set()
+        self._manifests = {}
 
     @property
     def _workspace(self):
@@ -53,46 +87,160 @@ class GeoserverServer(ServerBase):
         else:
             return ""
 
-    def prepareForPublishing(self, onlySymbology):
-        if not onlySymbology:
+    def manifest(self):
+        key = "%s|%s" % (self.url, self._workspace)
+        if key not in self._manifests:
+            self._manifests[key] = PublishManifest(key)
+        return self._manifests[key]
+
+    def prepareForPublishing(self, onlySymbology, incremental=False):
+        self._incremental = incremental
+        self.refreshCatalog()
+        self._catalogPinned = True
+        if not onlySymbology and not incremental:
             self.deleteWorkspace()
         self._ensureWorkspaceExists()
         self._uploadedDatasets = {}
         self._exportedLayers = {}
+        self._sourceLocks = {}
+        self._unchangedData = set()
         self._postgisDatastoreExists = False
 
     def closePublishing(self):
-        pass
+        self._catalogPinned = False
 
     def publishStyle(self, layer):
         styleFilename = tempFilenameInTempFolder(layer.name() + ".zip")
-        warnings = saveLayerStyleAsZippedSld(layer, styleFilename)
+        with qgisLock():
+            warnings = saveLayerStyleAsZippedSld(layer, styleFilename)
         for w in warnings:
             self.logWarning(w)
         self.logInfo(QCoreApplication.translate("GeocatBridge", "Style for layer %s exported as zip file to %s")
                      % (layer.name(), styleFilename))
+        fingerprint = zipFingerprint(styleFilename)
+        if (self._incremental and self.manifest().isUnchanged(layer.name(), STYLE, fingerprint)
+                and self.styleExists(layer.name())):
+            self.logInfo(QCoreApplication.translate("GeocatBridge", "Style for layer %s has not changed. Skipping upload")
+                     % layer.name())
+            return styleFilename
         self._publishStyle(layer.name(), styleFilename)
+        self.manifest().setFingerprint(layer.name(), STYLE, fingerprint)
         return styleFilename
 
+    def _sourceLock(self, source):
+        # layers sharing a source reuse the same upload, so they must not
+        # export and upload it at the same time
+        with self._sourceLocksLock:
+            return self._sourceLocks.setdefault(source, threading.Lock())
+
     def publishLayer(self, layer, fields=None):        
         self.publishStyle(layer)
+        name = layer.name()
+        fingerprint = dataFingerprint(layer, fields, self.storage)
+        if (self._incremental and self.manifest().isUnchanged(name, DATA, fingerprint)
+                and self._dataExists(layer)):
+            self.logInfo(QCoreApplication.translate("GeocatBridge", "Data for layer %s has not changed. Skipping upload")
+                     % name)
+            self._unchangedData.add(name)
+            return
+        self._unchangedData.discard(name)
+        self.manifest().remove(name, DATA)
+        with self._sourceLock(layer.source()):
+            self._publishLayerData(layer, fields)
+        self.manifest().setFingerprint(name, DATA, fingerprint)
+
+    def _dataExists(self, layer):
+        if not self.layerExists(layer.name()):
+            return False
+        if layer.type() == layer.VectorLayer and self.storage == self.POSTGIS_MANAGED_BY_BRIDGE:
+            return self._postgisServer().tableExists(layer.name())
+        return True
+
+    def _postgisServer(self):
+        try:
+            from .servers import allServers
+            return allServers()[self.postgisdb]
+        except KeyError:
+            raise Exception(QCoreApplication.translate("GeocatBridge", "Cannot find the selected PostGIS database"))
+
+    def _sharedPath(self, filename):
+        # path of a local file as seen by GeoServer, or None if it is not
+        # in the shared folder
+        if not self.localPath:
+            return None
+        localRoot = os.path.abspath(self.localPath)
+        path = os.path.abspath(filename)
+        try:
+            if os.path.normcase(os.path.commonpath([localRoot, path])) != os.path.normcase(localRoot):
+                return None
+        except ValueError:
+            return None
+        relative = os.path.relpath(path, localRoot).replace(os.sep, "/")
+        serverRoot = (self.serverPath or self.localPath).rstrip("/\\")
+        return "%s/%s" % (serverRoot, relative)
+
+    def _exportToSharedFolder(self, layer, fields, extension):
+        # Data already in the shared folder is used where it is. Anything else
+        # is exported to a folder for the workspace inside the shared folder
+        if not self.localPath:
+            raise Exception(QCoreApplication.translate("GeocatBridge", "The shared folder for GeoServer data has not been configured"))
+        source = layer.source()
+        if source not in self._exportedLayers:
+            filename = source.split("|")[0]
+            if (layer.type() == layer.RasterLayer and self._sharedPath(filename) is not None
+                    and canPassThrough(layer, rasterExportOptions())):
+                path = filename
+            else:
+                folder = os.path.join(self.localPath, "bridge", self._workspace)
+                os.makedirs(folder, exist_ok=True)
+                target = os.path.join(folder, layer.name() + extension)
+                with qgisLock():
+                    path = exportLayer(layer, fields, path=target, log=self)
+                    if self._sharedPath(path) is None:
+                        path = exportLayer(layer, fields, path=target, force=True, log=self)
+            self._exportedLayers[source] = path
+        return self._exportedLayers[source]
+
+    def _exportForImporter(self, layer, fields):
+        # Shapefiles cannot be larger than 2 GB, so bigger layers (or those
+        # that did not fit in the shapefile) are sent as GeoPackage
+        size = sum(os.path.getsize(f) for f in sourceFiles(layer))
+        if size < SHAPEFILE_SIZE_LIMIT:
+            with qgisLock():
+                path = exportLayer(layer, fields, toShapefile=True, force=True, log=self)
+            if self._isCompleteShapefile(path, layer):
+                return path
+        self.logInfo(QCoreApplication.translate("GeocatBridge", "Layer %s is too large for a shapefile. Sending it as GeoPackage")
+                     % layer.name())
+        with qgisLock():
+            return exportLayer(layer, fields, log=self)
+
+    def _isCompleteShapefile(self, path, layer):
+        basename = os.path.splitext(path)[0]
+        for ext in [".shp", ".dbf"]:
+            if os.path.getsize(basename + ext) >= SHAPEFILE_SIZE_LIMIT:
+                return False
+        ds = ogr.Open(path)
+        if ds is None:
+            return False
+        count = layer.featureCount()
+        return count < 0 or ds.GetLayer(0).GetFeatureCount() == count
+
+    def _publishLayerData(self, layer, fields):
         if layer.type() == layer.VectorLayer:
             if layer.featureCount() == 0:
                 self.logError("Layer contains zero features and cannot be published")
                 return
-            if self.storage in [self.FILE_BASED, self.POSTGIS_MANAGED_BY_GEOSERVER]:
+            if self.storage == self.SHARED_FOLDER:
+                filename = self._exportToSharedFolder(layer, fields, ".gpkg")
+                self._publishVectorLayerFromFile(layer, filename)
+            elif self.storage in [self.FILE_BASED, self.POSTGIS_MANAGED_BY_GEOSERVER]:
                 if layer.source() not in self._exportedLayers:
                     if self.storage == self.POSTGIS_MANAGED_BY_GEOSERVER:                    
-                        path = exportLayer(layer, fields, toShapefile=True, force=True, log=self)
-                        basename = os.path.splitext(path)[0]
-                        zipfilename = basename + ".zip"
-                        with ZipFile(zipfilename,'w') as z:
-                            for ext in [".shp", ".shx", ".prj", ".dbf"]:
-                                filetozip = basename + ext
-                                z.write(filetozip, arcname=os.path.basename(filetozip))
-                        self._exportedLayers[layer.source()] = zipfilename
+                        self._exportedLayers[layer.source()] = self._exportForImporter(layer, fields)
                     else:
-                        path = exportLayer(layer, fields, log=self)
+                        with qgisLock():
+                            path = exportLayer(layer, fields, log=self)
                         self._exportedLayers[layer.source()] = path
                 filename = self._exportedLayers[layer.source()]
                 if self.storage == self.FILE_BASED:
@@ -100,33 +248,46 @@ class GeoserverServer(ServerBase):
                 else:
                     self._publishVectorLayerFromFileToPostgis(layer, filename)
             elif self.storage == self.POSTGIS_MANAGED_BY_BRIDGE:            
+                db = self._postgisServer()
+                db.setCancelCallback(self.cancelCallback())
                 try:
-                    from .servers import allServers
-                    db = allServers()[self.postgisdb]
-                except KeyError:
-                    raise Exception(QCoreApplication.translate("GeocatBridge", "Cannot find the selected PostGIS database"))
-                db.importLayer(layer, fields)                
+                    changes = db.importLayer(layer, fields, sync=self._incremental)
+                finally:
+                    db.setCancelCallback(None)
+                if changes is not None:
+                    self.logNote(QCoreApplication.translate("GeocatBridge", "PostGIS table synchronized: %i rows inserted, %i updated, %i deleted")
+                                 % changes)                
                 self._publishVectorLayerFromPostgis(layer, db)            
+        elif layer.type() == layer.RasterLayer and self.storage == self.SHARED_FOLDER:
+            filename = self._exportToSharedFolder(layer, fields, ".tif")
+            self._publishRasterLayer(filename, layer.name())
         elif layer.type() == layer.RasterLayer:
             if layer.source() not in self._exportedLayers:
-                path = exportLayer(layer, fields, log=self)
+                with qgisLock():
+                    path = exportLayer(layer, fields, log=self)
                 self._exportedLayers[layer.source()] = path
             filename = self._exportedLayers[layer.source()]
             self._publishRasterLayer(filename, layer.name())
-        self._clearCache()
 
     def createPostgisDatastore(self):
-        ws, name = self.postgisdb.split(":")
-        if not self.datastoreExists(name):
-            url = "%s/workspaces/%s/datastores/%s.json" % (self.url, ws, name)
-            r = self.request(url)
-            datastore = r.json()["dataStore"]
-            newDatastore = {"dataStore":{"name": datastore["name"],
-                                        "type": datastore["type"],
-                                        "connectionParameters": datastore["connectionParameters"],
-                                        "enabled": True}}            
-            url = "%s/workspaces/%s/datastores" % (self.url, self._workspace)
-            r = self.request(url, newDatastore, "post")
+        # layers are published concurrently, but the datastore they share
+        # must only be created once
+        with self._datastoreLock:
+            if self._postgisDatastoreExists:
+                return
+            ws, name = self.postgisdb.split(":")
+            if not self.datastoreExists(name):
+                url = "%s/workspaces/%s/datastores/%s.json" % (self.url, ws, name)
+                r = self.request(url)
+                datastore = r.json()["dataStore"]
+                newDatastore = {"dataStore":{"name": datastore["name"],
+                                            "type": datastore["type"],
+                                            "connectionParameters": datastore["connectionParameters"],
+                                            "enabled": True}}            
+                url = "%s/workspaces/%s/datastores" % (self.url, self._workspace)
+                r = self.request(url, newDatastore, "post")
+                self._catalogAdd(DATASTORE, name)
+            self._postgisDatastoreExists = True
 
     def testConnection(self):
         try:
@@ -139,6 +300,7 @@ class GeoserverServer(ServerBase):
     def unpublishData(self, layer):
         self.deleteLayer(layer.name())
         self.deleteStyle(layer.name()) 
+        self.manifest().remove(layer.name())
 
     def baseUrl(self):
         return "/".join(self.url.split("/")[:-1])
@@ -148,10 +310,15 @@ class GeoserverServer(ServerBase):
         name = layer.name()
         isDataUploaded = filename in self._uploadedDatasets
         if not isDataUploaded:
-            with open(filename, "rb") as f:
-                self._deleteDatastore(name)
+            self._deleteDatastore(name)
+            sharedPath = self._sharedPath(filename) if self.storage == self.SHARED_FOLDER else None
+            if sharedPath is None:
                 url = "%s/workspaces/%s/datastores/%s/file.gpkg?update=overwrite" % (self.url, self._workspace, name)
-                self.request(url, f.read(), "put")            
+                self.withRetries(lambda: self.request(url, self.fileBody(filename), "put"))
+            else:
+                url = "%s/workspaces/%s/datastores/%s/external.gpkg?update=overwrite" % (self.url, self._workspace, name)
+                self.request(url, "file:%s" % sharedPath, "put", {"Content-type": "text/plain"})
+            self._catalogAdd(DATASTORE, name)
             conn = sqlite3.connect(filename)
             cursor = conn.cursor()
             cursor.execute("SELECT table_name FROM gpkg_geometry_columns")
@@ -176,6 +343,7 @@ class GeoserverServer(ServerBase):
             r = self.request(url, ft, "post")
         else:
             r = self.request(url, ft, "put")
+        self._catalogAdd(LAYER, name)
         self.logInfo("Feature type correctly created from GPKG file '%s'" % filename)
         self._setLayerStyle(name, name)
 
@@ -202,8 +370,10 @@ class GeoserverServer(ServerBase):
                 }
             }
         }
+        self._deleteDatastore(name)
         dsUrl = "%s/workspaces/%s/datastores/" % (self.url, self._workspace)
         self.request(dsUrl, data=ds, method="post")
+        self._catalogAdd(DATASTORE, name)
         ft = {
             "featureType": {
                 "name": name,
@@ -212,6 +382,7 @@ class GeoserverServer(ServerBase):
         }    
         ftUrl = "%s/workspaces/%s/datastores/%s/featuretypes" % (self.url, self._workspace, name)        
         self.request(ftUrl, data=ft, method="post")             
+        self._catalogAdd(LAYER, name)
         self._setLayerStyle(name, name)
 
     def _publishVectorLayerFromFileToPostgis(self, layer, filename):
@@ -239,9 +410,26 @@ class GeoserverServer(ServerBase):
             ret = self.request(url, _import, "post")
             importId = ret.json()["import"]["id"]
             url = "%s/imports/%s/tasks" % (self.url, importId)
-            with open(filename, "rb") as f:
-                files = {os.path.basename(filename): f}
-                ret = self.request(url, method="post", files=files)
+            basename, ext = os.path.splitext(filename)
+            if ext.lower() == ".shp":
+                # the shapefile is zipped while it is uploaded
+                files = [basename + e for e in SHAPEFILE_EXTENSIONS if os.path.exists(basename + e)]
+                layername = os.path.basename(basename)
+                def _upload():
+                    body, contentType = self.multipartZipBody(files, layername + ".zip")
+                    return self.request(url, body, "post", {"Content-Type": contentType})
+            else:
+                conn = sqlite3.connect(filename)
+                try:
+                    layername = conn.execute("SELECT table_name FROM gpkg_geometry_columns").fetchall()[0][0]
+                finally:
+                    conn.close()
+                def _upload():
+                    body, contentType = self.multipartFileBody(filename)
+                    return self.request(url, body, "post", {"Content-Type": contentType})
+            # the import is kept on the server, so a failed transfer only
+            # repeats the upload of this task
+            ret = self.withRetries(_upload)
             taskId = ret.json()["task"]["id"]
             target = {"dataStore": {
                         "name": datastoreName
@@ -251,7 +439,6 @@ class GeoserverServer(ServerBase):
             self.request(url, target, "put")
             url = "%s/imports/%s" % (self.url, importId)
             self.request(url, method="post")
-            layername = os.path.splitext(os.path.basename(filename))[0]
             self._uploadedDatasets[filename] = (datastoreName, layername)
         datasetName, geoserverLayerName = self._uploadedDatasets[filename]
         url = "%s/workspaces/%s/datastores/%s/featuretypes/%s.json" % (self.url, self._workspace, datasetName, geoserverLayerName)
@@ -261,21 +448,105 @@ class GeoserverServer(ServerBase):
         ft["featureType"]["title"] = name                
         try:
             ftUrl = "%s/workspaces/%s/datastores/%s/featuretypes" % (self.url, self._workspace, datasetName)
-            r = self.request(ftpUrl, ft, "post")
+            r = self.request(ftUrl, ft, "post")
         except:            
             r = self.request(url, ft, "put")
+        self._catalogAdd(LAYER, name)
         self.logInfo("Feature type correctly created from GPKG file '%s'" % filename)
         self._setLayerStyle(name, name)
 
     def _publishRasterLayer(self, filename, layername):
         #feedback.setText("Publishing data for layer %s" % layername)
         self._ensureWorkspaceExists()
-        with open(filename, "rb") as f:
+        uploadedPath = None
+        if self.storage == self.SHARED_FOLDER:
+            uploadedPath = self._sharedPath(filename)
+        elif os.path.getsize(filename) > self._resumableUploadThreshold():
+            uploadedPath = self._resumableUpload(filename)
+        if uploadedPath is None:
             url = "%s/workspaces/%s/coveragestores/%s/file.geotiff" % (self.url, self._workspace, layername)
-            self.request(url, f.read(), "put")
+            self.withRetries(lambda: self.request(url, self.fileBody(filename), "put"))
+        else:
+            url = ("%s/workspaces/%s/coveragestores/%s/external.geotiff?configure=first&coverageName=%s" 
+                    % (self.url, self._workspace, layername, layername))
+            self.request(url, "file:%s" % uploadedPath, "put", {"Content-type": "text/plain"})
+        self._catalogAdd(COVERAGESTORE, layername)
+        self._catalogAdd(LAYER, layername)
         self.logInfo("Feature type correctly created from Tiff file '%s'" % filename)
         self._setLayerStyle(layername, layername)
 
+    def _resumableUploadThreshold(self):
+        try:
+            threshold = int(QSettings().value(RESUMABLE_THRESHOLD_SETTING, DEFAULT_RESUMABLE_THRESHOLD))
+        except (TypeError, ValueError):
+            threshold = DEFAULT_RESUMABLE_THRESHOLD
+        return threshold * 1024 * 1024
+
+    def _resumableUpload(self, filename):
+        # Uses the GeoServer resumable upload endpoint: the file is sent in
+        # chunks with a Content-Range header, and after a transient error the
+        # server is asked how many bytes it already has, so the transfer
+        # continues from there. Returns the path of the file as reported by
+        # GeoServer when the upload completes, or None if the endpoint is not
+        # available.
+        path = "data/bridge/%s/%s" % (self._workspace, os.path.basename(filename))
+        url = "%s/resumableupload" % self.url
+        try:
+            r = self.request(url, path, "post", {"Content-type": "text/plain"})
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code in [404, 405]:
+                self.logInfo("Resumable uploads are not supported by the server")
+                return None
+            raise
+        uploadUrl = "%s/%s" % (url, r.text.strip())
+        total = os.path.getsize(filename)
+        offset = 0
+        attempt = 0
+        destination = None
+        self.logInfo("Starting resumable upload of '%s' (%i bytes)" % (filename, total))
+        with open(filename, "rb") as f:
+            while offset < total:
+                self.checkCanceled()
+                try:
+                    f.seek(offset)
+                    chunk = f.read(RESUMABLE_CHUNK_SIZE)
+                    end = offset + len(chunk) - 1
+                    headers = {"Content-Range": "bytes %i-%i/%i" % (offset, end, total)}
+                    r = self.request(uploadUrl, chunk, "put", headers)
+                    offset = self._uploadedBytes(r, end + 1)
+                    destination = self._uploadedPath(r) or destination
+                    self._reportUploadProgress(offset, total)
+                    attempt = 0
+                except Exception as e:
+                    if attempt >= MAX_RETRIES or not self._isTransientError(e):
+                        raise
+                    wait = RETRY_DELAY * 2 ** attempt
+                    self.logInfo("Upload interrupted at byte %i (%s). Resuming in %i seconds" % (offset, e, wait))
+                    time.sleep(wait)
+                    attempt += 1
+                    r = self.withRetries(lambda: self.request(uploadUrl, None, "put", 
+                                                              {"Content-Range": "bytes */%i" % total}))
+                    offset = self._uploadedBytes(r, offset)
+                    destination = self._uploadedPath(r) or destination
+        if destination is None:
+            raise Exception(QCoreApplication.translate("GeocatBridge", "GeoServer did not report where the file '%s' was uploaded") 
+                            % filename)
+        return destination
+
+    def _uploadedPath(self, response):
+        # the request that completes the upload returns the path where
+        # GeoServer stored the file
+        if response.status_code == 308:
+            return None
+        return response.text.strip() or None
+
+    def _uploadedBytes(self, response, default):
+        if response.status_code == 308:
+            # "Resume incomplete": the Range header tells the bytes received so far
+            uploaded = response.headers.get("Range")
+            return int(uploaded.split("-")[-1]) + 1 if uploaded else 0
+        return default
+
     def createGroups(self, groups):      
         for group in groups:
             self._publishGroup(group)
@@ -300,6 +571,7 @@ class GeoserverServer(ServerBase):
             self.request(url, groupdef, "post")
         except:
             self.request(url, groupdef, "put")
+        self._catalogAdd(LAYERGROUP, group["name"])
 
         self.logInfo("Group %s correctly created" % group["name"])
 
@@ -307,47 +579,81 @@ class GeoserverServer(ServerBase):
         if self.styleExists(name):
             url = "%s/workspaces/%s/styles/%s?purge=true&recurse=true" % (self.url, self._workspace, name)        
             r = self.request(url, method="delete")
-
-    def _clearCache(self):
-        self._layersCache = None
-
-    def _exists(self, url, category, name):
-        try:            
-            if category != "layer" or self._layersCache is None:
-                r = self.request(url)
-                root = r.json()["%ss" % category]
-                if category in root:            
-                    items = [s["name"] for s in root[category]]
-                    if category == "layer":
-                        self._layersCache = items
-                else:
-                    return False
-            else: 
-                items = self._layersCache
-            return name in items
+            self._catalogRemove(STYLE_RESOURCE, name)
+            self.manifest().remove(name, STYLE)
+
+    def refreshCatalog(self):
+        # One listing per resource type, kept up to date as Bridge creates
+        # and deletes resources, so existence checks do not hit the server
+        catalog = {category: set() for category in CATALOG_LISTINGS}
+        catalog[WORKSPACE] = set(self._list("%s/workspaces.json" % self.url, WORKSPACE))
+        if self._workspace in catalog[WORKSPACE]:
+            for category, listing in CATALOG_LISTINGS.items():
+                url = "%s/workspaces/%s/%s.json" % (self.url, self._workspace, listing)
+                catalog[category] = set(self._list(url, category))
+        with self._catalogLock:
+            self._catalog = catalog
+            self._catalogWorkspace = self._workspace
+            self._catalogTime = time.time()
+
+    def _list(self, url, category):
+        try:
+            r = self.request(url)
+            root = r.json()["%ss" % category]
+            if category in root:
+                return [s["name"] for s in root[category]]
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+        return []
+
+    def _catalogIsValid(self):
+        return (self._catalog is not None and self._catalogWorkspace == self._workspace
+                and (self._catalogPinned or time.time() - self._catalogTime < CATALOG_MAX_AGE))
+
+    def _catalogAdd(self, category, name):
+        with self._catalogLock:
+            if self._catalog is not None:
+                self._catalog[category].add(name)
+
+    def _catalogRemove(self, category, name):
+        with self._catalogLock:
+            if self._catalog is not None:
+                self._catalog[category].discard(name)
+
+    def _exists(self, category, name):
+        try:
+            with self._catalogLock:
+                if not self._catalogIsValid():
+                    self.refreshCatalog()
+                return name in self._catalog[category]
         except:
             return False            
 
+    def layerNames(self):
+        with self._catalogLock:
+            if not self._catalogIsValid():
+                self.refreshCatalog()
+            return set(self._catalog[LAYER])
+
     def layerExists(self, name):
-        url = "%s/workspaces/%s/layers.json" % (self.url, self._workspace)
-        return self._exists(url, "layer", name)
+        return self._exists(LAYER, name)
 
     def styleExists(self, name):
-        url = "%s/workspaces/%s/styles.json" % (self.url, self._workspace)
-        return self._exists(url, "style", name)
+        return self._exists(STYLE_RESOURCE, name)
 
     def workspaceExists(self):
-        url = "%s/workspaces.json" % (self.url)
-        return self._exists(url, "workspace", self._workspace)
+        return self._exists(WORKSPACE, self._workspace)
 
     def datastoreExists(self, name):
-        url = "%s/workspaces%s/datastores.json" % (self.url, self._workspace)
-        return self._exists(url, "dataStore", name)
+        return self._exists(DATASTORE, name)
 
     def _deleteDatastore(self, name):
         url = "%s/workspaces/%s/datastores/%s?recurse=true" % (self.url, self._workspace, name)
         try:
             r = self.request(url, method="delete")            
+            self._catalogRemove(DATASTORE, name)
+            self._catalogRemove(LAYER, name)
         except:
             pass
 
@@ -356,6 +662,9 @@ class GeoserverServer(ServerBase):
             recurseParam = 'recurse=true' if recurse else ""
             url = "%s/workspaces/%s/layers/%s.json?%s" % (self.url, self._workspace, name, recurseParam)
             r = self.request(url, method="delete")
+            self._catalogRemove(LAYER, name)
+            self.manifest().remove(name, DATA)
+            self.manifest().remove(name, METADATA_LINK)
         
     def openPreview(self, names, bbox, srs):
         url = self.layerPreviewUrl(names, bbox, srs)
@@ -372,6 +681,11 @@ class GeoserverServer(ServerBase):
         return "%s/%s/wms?service=WMS&version=1.1.0&request=GetMap&layers=%s"% (self.baseUrl(), self._workspace, name)        
         
     def setLayerMetadataLink(self, name, url):
+        if (self._incremental and name in self._unchangedData
+                and self.manifest().isUnchanged(name, METADATA_LINK, url)):
+            return
+        self.manifest().remove(name, METADATA_LINK)
+        metadataUrl = url
         url = "%s/workspaces/%s/layers/%s.json" % (self.url, self._workspace, name)
         r = self.request(url)
         resourceUrl = r.json()["layer"]["resource"]["href"]
@@ -383,17 +697,21 @@ class GeoserverServer(ServerBase):
                 {
                     "type": "text/html",
                     "metadataType": "ISO19115:2003",
-                    "content": url
+                    "content": metadataUrl
                 }
             ]
         }
         r = self.request(resourceUrl, data=layer, method="put")
+        self.manifest().setFingerprint(name, METADATA_LINK, metadataUrl)
 
     def deleteWorkspace(self):
         if self.workspaceExists():
             url = "%s/workspaces/%s?recurse=true" % (self.url, self._workspace)
             r = self.request(url, method="delete")
-            self._clearCache()
+            with self._catalogLock:
+                if self._catalog is not None:
+                    self._catalog = {category: set() for category in self._catalog}
+        self.manifest().clear()
 
     def _publishStyle(self, name, styleFilename):
         #feedback.setText("Publishing style for layer %s" % name)
@@ -406,8 +724,8 @@ class GeoserverServer(ServerBase):
         else:
             url = self.url + "/workspaces/%s/styles?name=%s" % (self._workspace, name)
             method = "post"
-        with open(styleFilename, "rb") as f:
-            self.request(url, f.read(), method, headers)
+        self.request(url, self.fileBody(styleFilename), method, headers)
+        self._catalogAdd(STYLE_RESOURCE, name)
         self.logInfo(QCoreApplication.translate("GeocatBridge", "Style %s correctly created from Zip file '%s'"
                      % (name, styleFilename)))
 
@@ -427,6 +745,7 @@ class GeoserverServer(ServerBase):
             url = "%s/workspaces" % self.url
             ws = {"workspace": {"name": self._workspace}}
             self.request(url, data=ws, method="post")
+            self._catalogAdd(WORKSPACE, self._workspace)
             
     def postgisDatastores(self):
         url = "%s/workspaces.json" % (self.url)
@@ -481,4 +800,6 @@ class GeoserverServer(ServerBase):
         if "." in self._workspace:
             errors.add("QGIS project name contains unsupported characters ('.'). Save with a different name and try again")
         self.checkMinGeoserverVersion(errors)
+        if self.storage == self.SHARED_FOLDER and not os.path.isdir(self.localPath):
+            errors.add("The folder shared with GeoServer ('%s') cannot be found" % self.localPath)
 
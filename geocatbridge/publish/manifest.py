@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import threading
+from zipfile import ZipFile
+
+from qgis.core import QgsApplication
+
+DATA = "data"
+STYLE = "style"
+METADATA_LINK = "metadatalink"
+METADATA = "metadata"
+
+def manifestsFolder():
+    folder = os.path.join(QgsApplication.qgisSettingsDirPath(), "geocatbridge", "manifests")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def _hash(values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+def sourceFiles(layer):
+    path = layer.source().split("|")[0]
+    if not os.path.isfile(path):
+        return []
+    files = [path]
+    for suffix in ["-wal", ".aux.xml"]:
+        if os.path.isfile(path + suffix):
+            files.append(path + suffix)
+    base = os.path.splitext(path)[0]
+    for ext in [".shx", ".dbf", ".prj", ".cpg"]:
+        if os.path.isfile(base + ext):
+            files.append(base + ext)
+    return files
+
+def dataFingerprint(layer, fields=None, storage=None):
+    files = sourceFiles(layer)
+    if not files:
+        # data that does not live in local files (databases, memory layers...)
+        # cannot be fingerprinted cheaply, so it is always published
+        return None
+    if layer.type() == layer.VectorLayer and layer.isModified():
+        # unsaved edits do not change the files
+        return None
+    stats = [(f, os.path.getmtime(f), os.path.getsize(f)) for f in files]
+    subset = layer.subsetString() if layer.type() == layer.VectorLayer else ""
+    return _hash({"source": layer.source(),
+                  "files": stats,
+                  "fields": sorted(fields or []),
+                  "crs": layer.crs().authid(),
+                  "subset": subset,
+                  "storage": storage})
+
+def zipFingerprint(filename):
+    # zip entries carry timestamps, so only names and contents are hashed
+    sha = hashlib.sha1()
+    with ZipFile(filename) as z:
+        for name in sorted(z.namelist()):
+            sha.update(name.encode("utf-8"))
+            sha.update(z.read(name))
+    return sha.hexdigest()
+
+def metadataFingerprint(metadata, thumbnail):
+    # the MEF itself cannot be used, since its info file has timestamps
+    sha = hashlib.sha1(metadata)
+    sha.update(thumbnail)
+    return sha.hexdigest()
+
+
+class PublishManifest():
+
+    def __init__(self, key):
+        self.key = key
+        self.filename = os.path.join(manifestsFolder(), hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+        self._lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(self.filename) as f:
+                stored = json.load(f)
+            if stored.get("key") == key:
+                self._entries = stored.get("layers", {})
+        except (IOError, ValueError):
+            pass
+
+    def fingerprint(self, name, part):
+        with self._lock:
+            return self._entries.get(name, {}).get(part)
+
+    def isUnchanged(self, name, part, fingerprint):
+        return fingerprint is not None and self.fingerprint(name, part) == fingerprint
+
+    def setFingerprint(self, name, part, fingerprint):
+        with self._lock:
+            if fingerprint is None:
+                self._entries.get(name, {}).pop(part, None)
+            else:
+                self._entries.setdefault(name, {})[part] = fingerprint
+            self._save()
+
+    def remove(self, name, part=None):
+        with self._lock:
+            if part is None:
+                self._entries.pop(name, None)
+            else:
+                self._entries.get(name, {}).pop(part, None)
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._save()
+
+    def _save(self):
+        with open(self.filename, "w") as f:
+            json.dump({"key": self.key, "layers": self._entries}, f)
@@ -18,6 +18,7 @@ from geocatbridge.utils.files import tempFolder
 from .ftpupload import uploadFolder
 from .serverbase import ServerBase
 from .exporter import exportLayer
+from ..utils.concurrency import qgisLock
 
 class MapserverServer(ServerBase): 
 
@@ -46,7 +47,8 @@ class MapserverServer(ServerBase):
         self.publishStyle(layer)
         layerFilename = layer.name() + ".shp"
         layerPath = os.path.join(self.dataFolder(), layerFilename)
-        exportLayer(layer, fields, toShapefile=True, path=layerPath, force=True, log=self)
+        with qgisLock():
+            exportLayer(layer, fields, toShapefile=True, path=layerPath, force=True, log=self)
 
     def uploadFolder(self, folder):
         username, password = getCredentials()
@@ -55,7 +57,11 @@ class MapserverServer(ServerBase):
     def testConnection(self):
         return True
 
-    def prepareForPublishing(self, onlySymbology):
+    def maxConcurrency(self):
+        # layers are written to the mapfile in the order they are published
+        return 1
+
+    def prepareForPublishing(self, onlySymbology, incremental=False):
         self._layers = []
         self._metadataLinks = {}
         self._folder = self.folder if self.useLocalFolder else tempFolder()
@@ -182,6 +188,9 @@ class MapserverServer(ServerBase):
     def layerExists(self, name):
         return False
 
+    def layerNames(self):
+        return []
+
     def deleteLayer(self, name):
         return False
     
@@ -1,77 +1,192 @@
+import io
 import os
+import json
 import uuid 
+import hashlib
 import zipfile
+import threading
 import lxml.etree as ET
-from xml.etree.ElementTree import Element, SubElement
-from xml.etree import ElementTree
-from xml.dom import minidom
 from datetime import datetime
-from qgis.PyQt.QtGui import QImage, QColor, QPainter
-from qgis.PyQt.QtCore import QSize, QCoreApplication
+from qgis.PyQt.QtGui import QColor
+from qgis.PyQt.QtCore import (QSize, QCoreApplication, QByteArray, QBuffer, QIODevice,
+                              QSettings, QStandardPaths)
+from qgis.PyQt.QtXml import QDomDocument
 from qgis.core import (
     QgsMapSettings, 
-    QgsMapRendererCustomPainterJob
+    QgsMapLayerStyle,
+    QgsMapRendererParallelJob
 )
-from ..utils.files import tempFilenameInTempFolder
+from .manifest import dataFingerprint
+from .exportcache import evict
+from ..utils.concurrency import qgisLock
 
 XSLTFILENAME = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources", "qgis-to-iso19139.xsl")
 INVERSEXSLTFILENAME = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources", "iso19139-to-qgis.xsl")
 
+QGIS_TO_ISO19139 = "qgis-to-iso19139"
+ISO19139_TO_QGIS = "iso19139-to-qgis"
+THUMBNAIL_SIZE_SETTING = "geocatbridge/ThumbnailSize"
+DEFAULT_THUMBNAIL_SIZE = 800
+THUMBNAIL_FORMAT_SETTING = "geocatbridge/ThumbnailFormat"
+THUMBNAIL_FORMATS = ["png", "jpg"]
+THUMBNAIL_CACHE_SIZE_SETTING = "geocatbridge/ThumbnailCacheSize"
+DEFAULT_THUMBNAIL_CACHE_SIZE = 100
+
+_stylesheets = {QGIS_TO_ISO19139: XSLTFILENAME, ISO19139_TO_QGIS: INVERSEXSLTFILENAME}
+_stylesheetsLock = threading.Lock()
+_compiled = threading.local()
+
+def registerStylesheet(name, filename):
+    # allows using other metadata profiles than the default ones
+    with _stylesheetsLock:
+        _stylesheets[name] = filename
+
+def stylesheet(name):
+    # Compiled stylesheets are cached, keyed by file and modification time
+    # so edited files are compiled again. lxml XSLT objects should not be
+    # shared between threads, so each thread keeps its own
+    with _stylesheetsLock:
+        filename = _stylesheets[name]
+    key = (filename, os.path.getmtime(filename))
+    cache = getattr(_compiled, "stylesheets", None)
+    if cache is None:
+        cache = _compiled.stylesheets = {}
+    if cache.get(name, (None, None))[0] != key:
+        cache[name] = (key, ET.XSLT(ET.parse(filename)))
+    return cache[name][1]
+
 def loadMetadataFromIsoXml(layer, filename):
-    qmdFilename = tempFilenameInTempFolder("fromiso.qmd")    
     dom = ET.parse(filename)
-    xslt = ET.parse(INVERSEXSLTFILENAME)
-    transform = ET.XSLT(xslt)
+    transform = stylesheet(ISO19139_TO_QGIS)
     newdom = transform(dom)
     if newdom is None:
         raise Exception("Cannot convert metadata")
-    s = '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(newdom, pretty_print=True).decode()
-    with open(qmdFilename, "w", encoding="utf8") as f:
-        f.write(s)
-    layer.loadNamedMetadata(qmdFilename)
+    doc = QDomDocument()
+    doc.setContent(ET.tostring(newdom, encoding="UTF-8", xml_declaration=True))
+    with qgisLock():
+        ok, error = layer.importNamedMetadata(doc)
+    if not ok:
+        raise Exception("Cannot convert metadata: %s" % error)
     
 def saveMetadataToIsoXml(layer, filename):
     pass
 
-def saveMetadata(layer, mefFilename=None, apiUrl=None, wms=None):
-    uuid = uuidForLayer(layer)
-    filename = tempFilenameInTempFolder(layer.name() + ".qmd")    
-    layer.saveNamedMetadata(filename)
-    thumbnail = saveLayerThumbnail(layer)
-    apiUrl = apiUrl or ""
-    transformedFilename = transformMetadata(filename, uuid, apiUrl, wms)
-    mefFilename = mefFilename or tempFilenameInTempFolder(uuid + ".mef")
-    createMef(uuid, transformedFilename, mefFilename, thumbnail)
+def saveMetadata(layer, mefFilename, apiUrl=None, wms=None):
+    with open(mefFilename, "wb") as f:
+        f.write(mefContent(layer, apiUrl, wms))
     return mefFilename
 
-def saveLayerThumbnail(layer):
-    filename = tempFilenameInTempFolder("thumbnail.png")
-    img = QImage(QSize(800,800), QImage.Format_A2BGR30_Premultiplied)
+def mefContent(layer, apiUrl=None, wms=None):
+    # the whole MEF is built in memory, from the layer metadata to the zip
+    return createMef(*metadataRecord(layer, apiUrl, wms))
+
+def metadataRecord(layer, apiUrl=None, wms=None):
+    # uuid, ISO metadata and thumbnail of a layer
+    uuid = uuidForLayer(layer)
+    doc = QDomDocument()
+    with qgisLock():
+        error = layer.exportNamedMetadata(doc)
+    thumbnail = layerThumbnail(layer)
+    if error:
+        raise Exception("Cannot export metadata: %s" % error)
+    qmd = ET.fromstring(bytes(doc.toByteArray()))
+    metadata = transformMetadata(qmd, uuid, apiUrl or "", wms)
+    return uuid, metadata, thumbnail
+
+def thumbnailSize():
+    try:
+        return max(16, int(QSettings().value(THUMBNAIL_SIZE_SETTING, DEFAULT_THUMBNAIL_SIZE)))
+    except (TypeError, ValueError):
+        return DEFAULT_THUMBNAIL_SIZE
+
+def thumbnailFormat():
+    fmt = str(QSettings().value(THUMBNAIL_FORMAT_SETTING, THUMBNAIL_FORMATS[0])).lower()
+    return fmt if fmt in THUMBNAIL_FORMATS else THUMBNAIL_FORMATS[0]
+
+def thumbnailFilename():
+    return "thumbnail.%s" % thumbnailFormat()
+
+def thumbnailsFolder():
+    folder = os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation),
+                          "geocatbridge", "thumbnails")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def thumbnailsCacheSize():
+    try:
+        return max(0, int(QSettings().value(THUMBNAIL_CACHE_SIZE_SETTING, DEFAULT_THUMBNAIL_CACHE_SIZE))) * 1024 * 1024
+    except (TypeError, ValueError):
+        return DEFAULT_THUMBNAIL_CACHE_SIZE * 1024 * 1024
+
+def _thumbnailKey(layer, size, fmt):
+    # only layers with file-based data can be fingerprinted cheaply
+    fingerprint = dataFingerprint(layer)
+    if fingerprint is None:
+        return None
+    style = QgsMapLayerStyle()
+    style.readFromLayer(layer)
+    values = {"data": fingerprint,
+              "style": style.xmlData(),
+              "extent": layer.extent().toString(),
+              "size": size,
+              "format": fmt}
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+def layerThumbnail(layer):
+    # Rendered thumbnails are cached on disk, so they are only rendered
+    # again when the data, the style or the thumbnail settings change
+    size = thumbnailSize()
+    fmt = thumbnailFormat()
+    maxSize = thumbnailsCacheSize()
+    with qgisLock():
+        key = _thumbnailKey(layer, size, fmt) if maxSize else None
+    if key is not None:
+        filename = os.path.join(thumbnailsFolder(), "%s.%s" % (key, fmt))
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            os.utime(filename)
+            return data
+        except OSError:
+            pass
+    data = _renderThumbnail(layer, size, fmt)
+    if key is not None:
+        partial = "%s.%s.partial" % (filename, uuid.uuid4().hex)
+        with open(partial, "wb") as f:
+            f.write(data)
+        os.replace(partial, filename)
+        evict(maxSize, thumbnailsFolder())
+    return data
+
+def _renderThumbnail(layer, size, fmt):
+    # The layer is only accessed while the job is set up, since starting it
+    # prepares renderers that do not depend on the layer any more. The
+    # rendering itself runs without blocking other workers
     color = QColor(255,255,255,255)
-    img.fill(color.rgba())
-    p = QPainter()
-    p.begin(img)
-    p.setRenderHint(QPainter.Antialiasing)
-    ms = QgsMapSettings()
-    ms.setBackgroundColor(color)        
-    ms.setLayers([layer])
-    ms.setExtent(layer.extent())
-    ms.setOutputSize(img.size())
-    render = QgsMapRendererCustomPainterJob(ms, p)
-    render.start()
+    with qgisLock():
+        ms = QgsMapSettings()
+        ms.setBackgroundColor(color)        
+        ms.setLayers([layer])
+        ms.setDestinationCrs(layer.crs())
+        ms.setExtent(layer.extent())
+        ms.setOutputSize(QSize(size, size))
+        ms.setFlag(QgsMapSettings.Antialiasing, True)
+        render = QgsMapRendererParallelJob(ms)
+        render.start()
     render.waitForFinished()
-    p.end()
-    img.save(filename)
-    return filename
+    img = render.renderedImage()
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    img.save(buffer, fmt.upper())
+    buffer.close()
+    return bytes(data)
 
-def transformMetadata(filename, uuid, apiUrl, wms):
+def transformMetadata(qmd, uuid, apiUrl, wms, profile=QGIS_TO_ISO19139):
     def _ns(n):
         return '{http://www.isotc211.org/2005/gmd}' + n
-    isoFilename = tempFilenameInTempFolder("metadata.xml")
-    dom = ET.parse(filename)
-    xslt = ET.parse(XSLTFILENAME)
-    transform = ET.XSLT(xslt)
-    newdom = transform(dom)    
+    transform = stylesheet(profile)
+    newdom = transform(qmd)    
     for ident in newdom.iter(_ns('fileIdentifier')):
         ident[0].text = uuid
     if wms is not None:
@@ -91,30 +206,36 @@ def transformMetadata(filename, uuid, apiUrl, wms):
         browseGraphic = ET.SubElement(overview, _ns('MD_BrowseGraphic'))
         file = ET.SubElement(browseGraphic, _ns('fileName'))
         cs = ET.SubElement(file, '{http://www.isotc211.org/2005/gco}CharacterString')
-        thumbnailUrl = "%s/records/%s/attachments/thumbnail.png" % (apiUrl , uuid)
+        thumbnailUrl = "%s/records/%s/attachments/%s" % (apiUrl , uuid, thumbnailFilename())
         cs.text = thumbnailUrl
-    s = '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(newdom, pretty_print=True).decode()
-    with open(isoFilename, "w", encoding="utf8") as f:
-        f.write(s)
-    
-    return isoFilename
+    return ET.tostring(newdom, pretty_print=True, encoding="UTF-8", xml_declaration=True)
+
+def createMef(uuid, metadata, thumbnail):
+    mef = io.BytesIO()
+    with zipfile.ZipFile(mef, "w") as z:
+        z.writestr("%s/metadata/metadata.xml" % uuid, metadata)
+        z.writestr("%s/public/%s" % (uuid, thumbnailFilename()), thumbnail)
+        z.writestr("%s/info.xml" % uuid, getInfoXmlContent(uuid, thumbnailFilename()))
+    return mef.getvalue()
 
-def createMef(uuid, metadataFilename, mefFilename, thumbnailFilename):
-    z = zipfile.ZipFile(mefFilename, "w")    
-    z.write(metadataFilename, os.path.join(uuid, "metadata", os.path.basename(metadataFilename)))
-    z.write(thumbnailFilename, os.path.join(uuid, "public", os.path.basename(thumbnailFilename)))
-    info = getInfoXmlContent(uuid, thumbnailFilename)
-    z.writestr(os.path.join(uuid, "info.xml"), info)
-    z.close()
+def mergeMefs(mefs):
+    # a MEF2 archive can hold several records, each one in its own folder
+    mef = io.BytesIO()
+    with zipfile.ZipFile(mef, "w") as merged:
+        for content in mefs:
+            with zipfile.ZipFile(io.BytesIO(content)) as z:
+                for info in z.infolist():
+                    merged.writestr(info, z.read(info))
+    return mef.getvalue()
 
 def _addSubElement(parent, tag, value=None, attrib=None):
-    sub = SubElement(parent, tag, attrib=attrib or {})
+    sub = ET.SubElement(parent, tag, attrib=attrib or {})
     if value is not None:
         sub.text = value
     return sub
 
 def getInfoXmlContent(uuid, thumbnailFilename):
-    root = Element("info", {"version": "1.1"})
+    root = ET.Element("info", {"version": "1.1"})
     general = _addSubElement(root, "general")
     d = datetime.now().isoformat()
     _addSubElement(general, "changeDate", d)
@@ -136,9 +257,7 @@ def getInfoXmlContent(uuid, thumbnailFilename):
     public = _addSubElement(root, "public")
     _addSubElement(public, "file", attrib = {"name": os.path.basename(thumbnailFilename), "changeDate": d})
     _addSubElement(root, "private")    
-    xmlstring = ElementTree.tostring(root, encoding='UTF-8', method='xml').decode()
-    dom = minidom.parseString(xmlstring)    
-    return dom.toprettyxml(indent="  ")    
+    return ET.tostring(root, pretty_print=True, encoding="UTF-8", xml_declaration=True)
 
 def uuidForLayer(layer):
     return str(uuid.uuid5(uuid.NAMESPACE_DNS, layer.source()))
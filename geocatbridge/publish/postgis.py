@@ -1,10 +1,250 @@
+import os
+import json
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+from queue import Queue, Full
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
-from qgis.core import (QgsVectorLayerExporter, 
-                        QgsFeatureSink, QgsFields)
+from psycopg2 import sql
+
+from qgis.core import QgsFields, QgsWkbTypes
+from qgis.PyQt.QtCore import QCoreApplication, QSettings, QVariant, QDate, QDateTime, QTime, QByteArray, Qt
 from .serverbase import ServerBase
 
-class PostgisServer(ServerBase): 
-    
+COPY_BATCH_SIZE = 50000
+WKB_SRID_FLAG = 0x20000000
+PARALLEL_IMPORT_THRESHOLD_SETTING = "geocatbridge/PostgisParallelImportThreshold"
+DEFAULT_PARALLEL_IMPORT_THRESHOLD = 1000000
+IMPORT_WORKERS_SETTING = "geocatbridge/PostgisImportWorkers"
+DEFAULT_IMPORT_WORKERS = min(8, os.cpu_count() or 1)
+STAGING_SUFFIX = "_bridge_staging"
+HASHES_SUFFIX = "_bridge_hashes"
+POOL_SIZE_SETTING = "geocatbridge/PostgisPoolSize"
+DEFAULT_POOL_SIZE = 10
+POOL_IDLE_TIMEOUT = 300
+POOL_HEALTH_CHECK_INTERVAL = 30
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+def postgisPoolSize():
+    try:
+        return max(1, int(QSettings().value(POOL_SIZE_SETTING, DEFAULT_POOL_SIZE)))
+    except (TypeError, ValueError):
+        return DEFAULT_POOL_SIZE
+
+def connectionPool(key, connect):
+    with _poolsLock:
+        for pool in _pools.values():
+            pool.closeIdle()
+        if key not in _pools:
+            _pools[key] = PostgisConnectionPool(connect, postgisPoolSize())
+        return _pools[key]
+
+def closeConnectionPool(key):
+    with _poolsLock:
+        pool = _pools.pop(key, None)
+    if pool is not None:
+        pool.closeAll()
+
+_COLUMN_TYPES = {QVariant.Int: "integer",
+                 QVariant.UInt: "bigint",
+                 QVariant.LongLong: "bigint",
+                 QVariant.ULongLong: "numeric",
+                 QVariant.Double: "double precision",
+                 QVariant.Bool: "boolean",
+                 QVariant.Date: "date",
+                 QVariant.Time: "time",
+                 QVariant.DateTime: "timestamp",
+                 QVariant.ByteArray: "bytea"}
+
+def _columnType(field):
+    if field.type() == QVariant.String:
+        return "varchar(%i)" % field.length() if field.length() > 0 else "text"
+    if field.type() == QVariant.StringList:
+        return "text[]"
+    if field.type() == QVariant.List:
+        return "%s[]" % _COLUMN_TYPES.get(field.subType(), "text")
+    if field.type() == QVariant.Map:
+        return "json"
+    return _COLUMN_TYPES.get(field.type(), "text")
+
+def _geometryColumnType(layer):
+    wkbType = layer.wkbType()
+    name = QgsWkbTypes.displayString(QgsWkbTypes.flatType(wkbType))
+    if name in ["Unknown", "NoGeometry"]:
+        name = "Geometry"
+    if QgsWkbTypes.hasZ(wkbType):
+        name += "Z"
+    if QgsWkbTypes.hasM(wkbType):
+        name += "M"
+    return "geometry(%s,%i)" % (name, layer.sourceCrs().postgisSrid())
+
+def _isNull(value):
+    return (value is None or (isinstance(value, QVariant) and value.isNull())
+            or (isinstance(value, (QDate, QDateTime, QTime)) and value.isNull()))
+
+def _textValue(value):
+    # text representation of a value, as PostgreSQL parses it
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (QDate, QDateTime, QTime)):
+        return value.toString(Qt.ISODate)
+    if isinstance(value, (QByteArray, bytes, bytearray)):
+        return "\\x" + bytes(value).hex()
+    if isinstance(value, dict):
+        return json.dumps({k: None if _isNull(v) else v for k, v in value.items()}, default=_textValue)
+    if isinstance(value, (list, tuple)):
+        return "{%s}" % ",".join(_arrayElement(v) for v in value)
+    return str(value)
+
+def _arrayElement(value):
+    if _isNull(value):
+        return "NULL"
+    text = _textValue(value)
+    return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"')
+
+def _copyValue(value):
+    if _isNull(value):
+        return "\\N"
+    value = _textValue(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+
+def _ewkbHex(geometry, srid):
+    # WKB does not carry the SRID, but the target column is constrained to
+    # one, so it is added to the header as in PostGIS extended WKB
+    wkb = bytes(geometry.asWkb())
+    if not srid:
+        return wkb.hex()
+    byteOrder = "<" if wkb[0] == 1 else ">"
+    wkbType = struct.unpack(byteOrder + "I", wkb[1:5])[0]
+    return (wkb[0:1] + struct.pack(byteOrder + "II", wkbType | WKB_SRID_FLAG, srid) + wkb[5:]).hex()
+
+
+def _rowHash(row):
+    return hashlib.md5(row.encode("utf-8")).hexdigest()
+
+
+class _CopyStream():
+
+    # file-like object that psycopg2 reads COPY data from, producing rows
+    # only as they are requested
+
+    def __init__(self, rows, isCanceled=None):
+        self._rows = rows
+        self._isCanceled = isCanceled
+        self._buffer = ""
+
+    def read(self, size=-1):
+        if self._isCanceled is not None and self._isCanceled():
+            raise Exception(QCoreApplication.translate("GeocatBridge", "Publishing was cancelled"))
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._rows)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    readline = read
+
+
+class PostgisConnectionPool():
+
+    # Bounded pool of psycopg2 connections. When all of them are in use,
+    # callers wait for one to be released. Connections idle for a while are
+    # checked before being reused, and closed if idle for too long
+
+    def __init__(self, connect, maxSize):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(maxSize)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._closed = False
+
+    @contextmanager
+    def connection(self):
+        con = self.getConnection()
+        try:
+            yield con
+        finally:
+            self.releaseConnection(con)
+
+    def getConnection(self):
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    self._closeIdle()
+                    con, lastUsed = self._idle.pop() if self._idle else (None, None)
+                if con is None:
+                    return self._connect()
+                if time.time() - lastUsed < POOL_HEALTH_CHECK_INTERVAL or self._isAlive(con):
+                    return con
+                self._close(con)
+        except:
+            self._slots.release()
+            raise
+
+    def releaseConnection(self, con):
+        try:
+            if self._closed or con.closed:
+                self._close(con)
+                return
+            if con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                con.rollback()
+            con.autocommit = False
+            with self._lock:
+                self._idle.append((con, time.time()))
+        except psycopg2.Error:
+            self._close(con)
+        finally:
+            self._slots.release()
+
+    def closeIdle(self):
+        with self._lock:
+            self._closeIdle()
+
+    def _closeIdle(self):
+        now = time.time()
+        expired = [c for c, lastUsed in self._idle if now - lastUsed > POOL_IDLE_TIMEOUT]
+        self._idle = [(c, lastUsed) for c, lastUsed in self._idle if now - lastUsed <= POOL_IDLE_TIMEOUT]
+        for con in expired:
+            self._close(con)
+
+    def closeAll(self):
+        with self._lock:
+            self._closed = True
+            for con, lastUsed in self._idle:
+                self._close(con)
+            self._idle = []
+
+    def _isAlive(self, con):
+        try:
+            with con.cursor() as cur:
+                cur.execute("SELECT 1")
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, con):
+        try:
+            con.close()
+        except psycopg2.Error:
+            pass
+
+
+class PostgisServer(ServerBase):
+
     def __init__(self, name, authid="", host="localhost", port="5432", schema="public", database="db"):
         super().__init__()
         self.name = name
@@ -16,40 +256,381 @@ class PostgisServer(ServerBase):
         self._isMetadataCatalog = False
         self._isDataCatalog = False
 
-    def importLayer(self, layer, fields):
+    def _connect(self):
         username, password = self.getCredentials()
-        uri = "dbname='%s' key='id' host=%s port=%s user='%s' password='%s' table=\"%s\".\"%s\" (geom) sql=" % (self.database, 
-                    self.host, self.port, username, password, self.schema, layer.name())
-        
+        return psycopg2.connect(dbname=self.database, user=username, password=password, host=self.host, port=self.port)
+
+    def _poolKey(self):
+        # connections opened with credentials that have since changed must
+        # not be reused
+        credentials = hashlib.sha1(("%s\n%s" % self.getCredentials()).encode("utf-8")).hexdigest()
+        return (self.name, self.host, str(self.port), self.database, self.authid, credentials)
+
+    def connection(self):
+        return connectionPool(self._poolKey(), self._connect).connection()
+
+    def closeSession(self):
+        super().closeSession()
+        closeConnectionPool(self._poolKey())
+
+    def tableExists(self, tableName):
+        with self.connection() as con:
+            with con:
+                with con.cursor() as cur:
+                    cur.execute("SELECT to_regclass(%s)", (sql.Identifier(self.schema, tableName).as_string(con),))
+                    return cur.fetchone()[0] is not None
+
+    def parallelImportThreshold(self):
+        try:
+            return int(QSettings().value(PARALLEL_IMPORT_THRESHOLD_SETTING, DEFAULT_PARALLEL_IMPORT_THRESHOLD))
+        except (TypeError, ValueError):
+            return DEFAULT_PARALLEL_IMPORT_THRESHOLD
+
+    def importWorkers(self):
+        try:
+            return max(1, int(QSettings().value(IMPORT_WORKERS_SETTING, DEFAULT_IMPORT_WORKERS)))
+        except (TypeError, ValueError):
+            return DEFAULT_IMPORT_WORKERS
+
+    def importLayer(self, layer, fields, sync=False):
+        # With sync, only the rows that changed since the last import are
+        # written, and the number of inserted, updated and deleted rows is
+        # returned. Otherwise (or if the table cannot be synchronized) the
+        # table is fully replaced and None is returned
         qgsfields = QgsFields()
         for f in layer.fields():
             if fields is None or f.name() in fields:
                 qgsfields.append(f)
-        exporter = QgsVectorLayerExporter(uri, "postgres", qgsfields,
-                                          layer.wkbType(), layer.sourceCrs(), True)
+        sync = sync and qgsfields.indexOf("id") == -1
+        workers = min(self.importWorkers(), postgisPoolSize())
+        try:
+            if sync:
+                # errors, cancellation included, leave the table untouched
+                changes = self._syncFeatures(layer, qgsfields)
+                if changes is not None:
+                    return changes
+                self.logWarning(QCoreApplication.translate("GeocatBridge", "Could not synchronize table {0}, it will be fully imported").format(layer.name()))
+            if not sync and workers > 1 and layer.featureCount() >= self.parallelImportThreshold():
+                self._importPartitioned(layer, qgsfields, workers)
+            else:
+                self._copyFeatures(layer, qgsfields, sync)
+        except psycopg2.Error as e:
+            raise Exception(QCoreApplication.translate("GeocatBridge", 'Error importing to PostGIS: {0}').format(e))
+
+    def _columnNames(self, layer, qgsfields):
+        # unless the layer has its own "id" field, the feature id is used
+        # as primary key, so rows can be matched to features when syncing
+        names = [f.name() for f in qgsfields]
+        if "id" not in names:
+            names.insert(0, "id")
+        if layer.isSpatial():
+            names.append("geom")
+        return names
+
+    def _createTable(self, layer, tableName, qgsfields, cur=None):
+        # with a cursor, the table is created in its transaction
+        columns = []
+        if qgsfields.indexOf("id") == -1:
+            columns.append(sql.SQL("{} bigint PRIMARY KEY").format(sql.Identifier("id")))
+        for f in qgsfields:
+            columnType = _columnType(f)
+            if f.name() == "id" and columnType in ["integer", "bigint"]:
+                columnType += " PRIMARY KEY"
+            columns.append(sql.SQL("{} " + columnType).format(sql.Identifier(f.name())))
+        if layer.isSpatial():
+            columns.append(sql.SQL("{} " + _geometryColumnType(layer)).format(sql.Identifier("geom")))
+        table = sql.Identifier(self.schema, tableName)
+        statements = [sql.SQL("DROP TABLE IF EXISTS {}").format(table),
+                      sql.SQL("CREATE TABLE {} ({})").format(table, sql.SQL(", ").join(columns))]
+        if cur is not None:
+            for statement in statements:
+                cur.execute(statement)
+            return
+        with self.connection() as con:
+            with con:
+                with con.cursor() as cur:
+                    for statement in statements:
+                        cur.execute(statement)
+
+    def _copyStatement(self, layer, tableName, qgsfields):
+        columns = [sql.Identifier(n) for n in self._columnNames(layer, qgsfields)]
+        return sql.SQL("COPY {} ({}) FROM STDIN").format(sql.Identifier(self.schema, tableName),
+                                                          sql.SQL(", ").join(columns))
+
+    def _rowEncoder(self, layer, qgsfields):
+        names = [f.name() for f in qgsfields]
+        addId = "id" not in names
+        srid = layer.sourceCrs().postgisSrid()
+        forceMulti = QgsWkbTypes.isMultiType(layer.wkbType())
+        spatial = layer.isSpatial()
+
+        def _row(feature):
+            values = [_copyValue(feature[n]) for n in names]
+            if addId:
+                values.insert(0, str(feature.id()))
+            if spatial:
+                geom = feature.geometry()
+                if geom.isNull() or geom.isEmpty():
+                    values.append("\\N")
+                else:
+                    if forceMulti and not geom.isMultipart():
+                        geom.convertToMultiType()
+                    values.append(_ewkbHex(geom, srid))
+            return "\t".join(values) + "\n"
 
-        if exporter.errorCode() != QgsVectorLayerExporter.NoError:
-            raise Exception(QCoreApplication.translate("GeocatBridge", 'Error importing to PostGIS: {0}').format(exporter.errorMessage()))
+        return _row
 
-        features = layer.getFeatures()
-        for f in features:
-            if not exporter.addFeature(f, QgsFeatureSink.FastInsert):
-                raise Exception(QCoreApplication.translate("GeocatBridge", 'Error importing to PostGIS: {0}').format(exporter.errorMessage()))
-        exporter.flushBuffer()
-        if exporter.errorCode() != QgsVectorLayerExporter.NoError:
-            raise Exception(QCoreApplication.translate("GeocatBridge", 'Error importing to PostGIS: {0}').format(exporter.errorMessage()))
+    def _hashesTable(self, tableName):
+        return sql.Identifier(self.schema, tableName + HASHES_SUFFIX)
+
+    def _writeHashes(self, cur, tableName, hashes):
+        # hashes is a file-like object with "id<TAB>hash" lines
+        table = self._hashesTable(tableName)
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(table))
+        cur.execute(sql.SQL("CREATE TABLE {} (id bigint PRIMARY KEY, hash char(32))").format(table))
+        cur.copy_expert(sql.SQL("COPY {} (id, hash) FROM STDIN").format(table).as_string(cur), hashes)
+
+    def _indexAndAnalyze(self, cur, layer, tableName):
+        table = sql.Identifier(self.schema, tableName)
+        if layer.isSpatial():
+            index = sql.Identifier("%s_geom_idx" % tableName)
+            cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING GIST (geom)").format(index, table))
+        cur.execute(sql.SQL("ANALYZE {}").format(table))
+
+    def _copyFeatures(self, layer, qgsfields, storeHashes=False):
+        # The table is created and features are streamed with COPY in large
+        # batches, all in a single transaction, so a failed or cancelled
+        # import leaves the previous table in place. The spatial index is built and the table analyzed only
+        # once the data is loaded. Row hashes, needed to synchronize the
+        # table later, are spooled to a temporary file and loaded at the end
+        tableName = layer.name()
+        _row = self._rowEncoder(layer, qgsfields)
+        isCanceled = self.cancelCallback()
+        hashesFile = tempfile.TemporaryFile("w+") if storeHashes else None
+        copied = [0]
+        def _batch(features):
+            for i, feature in enumerate(features):
+                row = _row(feature)
+                if hashesFile is not None:
+                    hashesFile.write("%i\t%s\n" % (feature.id(), _rowHash(row)))
+                yield row
+                copied[0] += 1
+                if i + 1 == COPY_BATCH_SIZE:
+                    return
+
+        try:
+            with self.connection() as con:
+                with con:
+                    with con.cursor() as cur:
+                        self._createTable(layer, tableName, qgsfields, cur)
+                        copy = self._copyStatement(layer, tableName, qgsfields).as_string(con)
+                        features = iter(layer.getFeatures())
+                        total = 0
+                        while True:
+                            copied[0] = 0
+                            cur.copy_expert(copy, _CopyStream(_batch(features), isCanceled))
+                            total += copied[0]
+                            if copied[0] < COPY_BATCH_SIZE:
+                                break
+                        self.logInfo("%i features copied to table %s.%s" % (total, self.schema, tableName))
+                        self._indexAndAnalyze(cur, layer, tableName)
+                        if hashesFile is not None:
+                            hashesFile.seek(0)
+                            self._writeHashes(cur, tableName, hashesFile)
+                        else:
+                            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(self._hashesTable(tableName)))
+        finally:
+            if hashesFile is not None:
+                hashesFile.close()
+
+    def _syncFeatures(self, layer, qgsfields):
+        # Rows are compared through the hashes stored at the previous import.
+        # Only new and modified features are sent, into a temporary table
+        # that is then merged into the target one. Everything runs in one
+        # transaction. Returns None if the table cannot be synchronized
+        tableName = layer.name()
+        table = sql.Identifier(self.schema, tableName)
+        hashesTable = self._hashesTable(tableName)
+        names = self._columnNames(layer, qgsfields)
+        _row = self._rowEncoder(layer, qgsfields)
+        isCanceled = self.cancelCallback()
+        with self.connection() as con:
+            with con:
+                with con.cursor() as cur:
+                    cur.execute("SELECT to_regclass(%s)", (hashesTable.as_string(con),))
+                    if cur.fetchone()[0] is None:
+                        return None
+                    cur.execute("SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(%s) "
+                                "AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+                                (table.as_string(con),))
+                    if [r[0] for r in cur.fetchall()] != names:
+                        return None
+                    cur.execute(sql.SQL("SELECT id, hash FROM {}").format(hashesTable))
+                    stored = dict(cur.fetchall())
+                    changed = []
+                    inserted = [0]
+
+                    def _changedRows():
+                        for feature in layer.getFeatures():
+                            row = _row(feature)
+                            rowHash = _rowHash(row)
+                            storedHash = stored.pop(feature.id(), None)
+                            if storedHash != rowHash:
+                                if storedHash is None:
+                                    inserted[0] += 1
+                                changed.append("%i\t%s\n" % (feature.id(), rowHash))
+                                yield row
+
+                    delta = sql.Identifier("_bridge_delta")
+                    cur.execute(sql.SQL("CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP").format(delta, table))
+                    columns = sql.SQL(", ").join([sql.Identifier(n) for n in names])
+                    cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN").format(delta, columns).as_string(con),
+                                    _CopyStream(_changedRows(), isCanceled))
+                    deleted = list(stored.keys())
+                    updates = sql.SQL(", ").join([sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(n))
+                                                    for n in names if n != "id"])
+                    if changed:
+                        cur.execute(sql.SQL("INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON CONFLICT (id) DO UPDATE SET {3}")
+                                        .format(table, columns, delta, updates))
+                        deltaHashes = sql.Identifier("_bridge_delta_hashes")
+                        cur.execute(sql.SQL("CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP").format(deltaHashes, hashesTable))
+                        cur.copy_expert(sql.SQL("COPY {} (id, hash) FROM STDIN").format(deltaHashes).as_string(con),
+                                        _CopyStream(iter(changed)))
+                        cur.execute(sql.SQL("INSERT INTO {} (id, hash) SELECT id, hash FROM {} "
+                                            "ON CONFLICT (id) DO UPDATE SET hash = EXCLUDED.hash")
+                                        .format(hashesTable, deltaHashes))
+                    if deleted:
+                        cur.execute(sql.SQL("DELETE FROM {} WHERE id = ANY(%s)").format(table), (deleted,))
+                        cur.execute(sql.SQL("DELETE FROM {} WHERE id = ANY(%s)").format(hashesTable), (deleted,))
+                    if changed or deleted:
+                        cur.execute(sql.SQL("ANALYZE {}").format(table))
+        changes = (inserted[0], len(changed) - inserted[0], len(deleted))
+        self.logInfo("Table %s.%s synchronized: %i rows inserted, %i updated, %i deleted"
+                     % ((self.schema, tableName) + changes))
+        return changes
+
+    def _importPartitioned(self, layer, qgsfields, workers):
+        # The layer is read once and split into consecutive feature-id
+        # partitions, which several workers load concurrently, each over its
+        # own connection, into an unlogged staging table. The staging table
+        # only replaces the target one when all partitions have been loaded
+        tableName = layer.name()
+        staging = tableName + STAGING_SUFFIX
+        self._createTable(layer, staging, qgsfields)
+        stagingTable = sql.Identifier(self.schema, staging)
+        _row = self._rowEncoder(layer, qgsfields)
+        isCanceled = self.cancelCallback()
+        partitions = Queue(maxsize=workers * 2)
+        failed = []
+
+        def _loadPartitions():
+            # any failure, including getting a connection, is recorded so the
+            # reader stops producing partitions
+            loaded = 0
+            try:
+                with self.connection() as con:
+                    with con:
+                        with con.cursor() as cur:
+                            copy = self._copyStatement(layer, staging, qgsfields).as_string(con)
+                            while True:
+                                features = partitions.get()
+                                if features is None:
+                                    break
+                                if failed:
+                                    # keep draining the queue so the reader is not blocked
+                                    continue
+                                cur.copy_expert(copy, _CopyStream((_row(f) for f in features), isCanceled))
+                                loaded += len(features)
+                            if failed:
+                                con.rollback()
+            except Exception as e:
+                failed.append(e)
+            return loaded
+
+        try:
+            self._execute(sql.SQL("ALTER TABLE {} SET UNLOGGED").format(stagingTable))
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                futures = [executor.submit(_loadPartitions) for i in range(workers)]
+
+                def _put(item):
+                    # never wait for workers that are gone
+                    while not all(f.done() for f in futures):
+                        try:
+                            partitions.put(item, timeout=1)
+                            return True
+                        except Full:
+                            pass
+                    return False
+
+                try:
+                    features = []
+                    for feature in layer.getFeatures():
+                        if failed:
+                            break
+                        features.append(feature)
+                        if len(features) == COPY_BATCH_SIZE:
+                            if not _put(features):
+                                break
+                            features = []
+                    if features and not failed:
+                        _put(features)
+                finally:
+                    for i in range(workers):
+                        _put(None)
+                total = sum(f.result() for f in futures)
+            finally:
+                executor.shutdown(wait=True)
+            if failed:
+                raise failed[0]
+            self.logInfo("%i features copied to table %s.%s using %i connections" % (total, self.schema, tableName, workers))
+            with self.connection() as con:
+                with con:
+                    with con.cursor() as cur:
+                        self._indexAndAnalyze(cur, layer, staging)
+                        cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(stagingTable))
+                with con:
+                    with con.cursor() as cur:
+                        self._swapTables(cur, layer, staging, tableName)
+        except:
+            try:
+                self._execute(sql.SQL("DROP TABLE IF EXISTS {}").format(stagingTable))
+            except psycopg2.Error:
+                pass
+            raise
+
+    def _swapTables(self, cur, layer, staging, tableName):
+        # runs inside a single transaction, so clients see either the old
+        # table or the new one. The index and primary key of the staging table
+        # are renamed as well, so their names do not clash with the next one
+        stagingTable = sql.Identifier(self.schema, staging)
+        cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'",
+                    (stagingTable.as_string(cur),))
+        constraints = [r[0] for r in cur.fetchall()]
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(self._hashesTable(tableName)))
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(self.schema, tableName)))
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(stagingTable, sql.Identifier(tableName)))
+        table = sql.Identifier(self.schema, tableName)
+        if layer.isSpatial():
+            cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(self.schema, "%s_geom_idx" % staging),
+                                                                       sql.Identifier("%s_geom_idx" % tableName)))
+        for conname in constraints:
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(table, sql.Identifier(conname),
+                                                                                   sql.Identifier(conname.replace(staging, tableName, 1))))
+
+    def _execute(self, statement):
+        with self.connection() as con:
+            with con:
+                with con.cursor() as cur:
+                    cur.execute(statement)
 
     def testConnection(self):
-        username, password = self.getCredentials()
-        con = None
         try:
-            con = psycopg2.connect(dbname=self.database, user=username, password=password, host=self.host, port=self.port)
-            cur = con.cursor()
-            cur.execute('SELECT version()')
-            cur.fetchone()[0]
+            with self.connection() as con:
+                with con:
+                    with con.cursor() as cur:
+                        cur.execute('SELECT version()')
+                        cur.fetchone()[0]
             return True
         except:
             return False
-        finally:
-            if con:
-                con.close()
\ No newline at end of file
@@ -2,6 +2,10 @@ import os
 import sys
 import traceback
 import string
+import queue
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from qgis.core import (
     QgsTask, 
@@ -28,6 +32,11 @@ from bridgestyle.qgis import saveLayerStyleAsZippedSld
 from .exporter import exportLayer
 
 from .metadata import uuidForLayer, saveMetadata
+from .serverbase import credentialsCacheStats
+from ..utils.concurrency import qgisLock
+
+_LAYER_DONE = object()
+_UPLOAD_PROGRESS = object()
 
 class PublishTask(QgsTask):
 
@@ -35,13 +44,14 @@ class PublishTask(QgsTask):
     stepStarted = pyqtSignal(str, int)
     stepSkipped = pyqtSignal(str, int)
 
-    def __init__(self, layers, fields, onlySymbology, geodataServer, metadataServer, parent):
+    def __init__(self, layers, fields, onlySymbology, geodataServer, metadataServer, parent, incremental=False):
         super().__init__("Publish from GeoCat Bridge", QgsTask.CanCancel)
         self.exception = None
         self.layers = layers
         self.geodataServer = geodataServer
         self.metadataServer = metadataServer
         self.onlySymbology = onlySymbology
+        self.incremental = incremental
         self.fields = fields
         self.parent = parent
 
@@ -89,90 +99,56 @@ class PublishTask(QgsTask):
                 if layer.type() in [QgsMapLayer.VectorLayer, QgsMapLayer.RasterLayer]]
         return layers
 
+    def maxConcurrentLayers(self):
+        servers = [s for s in [self.geodataServer, self.metadataServer] if s is not None]
+        if not servers:
+            return 1
+        return min(s.maxConcurrency() for s in servers)
+
     def run(self):
+        self._publishingOpen = False
         try:
-            validator = QgsNativeMetadataValidator()        
-            
-            DONOTALLOW = 0
-            ALLOW = 1
-            ALLOWONLYDATA = 2
-            
-            allowWithoutMetadata = ALLOW #pluginSetting("allowWithoutMetadata")
-
             if self.geodataServer is not None:
-                self.geodataServer.prepareForPublishing(self.onlySymbology)
-
-            self.results = {}            
-            for i, name in enumerate(self.layers):
-                if self.isCanceled():
-                    return False
-                warnings, errors = [], []
-                self.setProgress(i * 100 / len(self.layers))                
-                layer = self.layerFromName(name)
-                warnings.extend(self.validateLayer(layer))
-                validates, _ = validator.validate(layer.metadata())
-                validates = True
-                if self.geodataServer is not None:
-                    try:
-                        self.geodataServer.resetLog()
-                        self.stepStarted.emit(name, SYMBOLOGY)
-                        self.geodataServer.publishStyle(layer)
-                        self.stepFinished.emit(name, SYMBOLOGY)
-                    except:
-                        self.stepFinished.emit(name, SYMBOLOGY)
-                        errors.append(traceback.format_exc())
+                self._publishingOpen = True
+                self.geodataServer.prepareForPublishing(self.onlySymbology, self.incremental)
+            if self.metadataServer is not None:
+                self.metadataServer.prepareForMetadataPublishing(self.incremental)
+
+            self.results = {}
+            self._pendingMetadata = {}
+            self._pendingMetadataLock = threading.Lock()
+            # signals are only emitted from this thread. Workers queue their
+            # progress events, so the receivers see them in a consistent order
+            events = queue.Queue()
+            layers = [(name, self.layerFromName(name)) for name in self.layers]
+            executor = ThreadPoolExecutor(max_workers=self.maxConcurrentLayers())
+            try:
+                futures = [executor.submit(self._publishLayer, name, layer, events) 
+                            for name, layer in layers]
+                done = 0
+                uploads = {}
+                while done < len(futures):
+                    if self.isCanceled():
+                        for future in futures:
+                            future.cancel()
+                        return False
                     try:
-                        if self.onlySymbology:
-                            self.stepSkipped.emit(name, DATA)
-                        else:
-                            self.stepStarted.emit(name, DATA)
-                            if validates or allowWithoutMetadata in [ALLOW, ALLOWONLYDATA]:
-                                fields = None
-                                if layer.type() == layer.VectorLayer:
-                                    fields = [name for name, publish in self.fields[layer].items() if publish]                            
-                                self.geodataServer.publishLayer(layer, fields)
-                                if self.metadataServer is not None:
-                                    metadataUuid = uuidForLayer(layer)
-                                    url = self.metadataServer.metadataUrl(metadataUuid)
-                                    self.geodataServer.setLayerMetadataLink(name, url)
-                            else:
-                                self.geodataServer.logError(self.tr("Layer '%s' has invalid metadata. Layer was not published") % layer.name())
-                            self.stepFinished.emit(name, DATA)
-                    except:
-                        self.stepFinished.emit(name, DATA)
-                        errors.append(traceback.format_exc())
-                else:
-                    self.stepSkipped.emit(name, SYMBOLOGY)
-                    self.stepSkipped.emit(name, DATA)
-
-                if self.metadataServer is not None:
-                    try:
-                        self.metadataServer.resetLog()
-                        if validates or allowWithoutMetadata == ALLOW:
-                            if self.geodataServer is not None:
-                                wms = self.geodataServer.layerWmsUrl(layer.name())
-                            else:
-                                wms = None
-                            self.autofillMetadata(layer)
-                            self.stepStarted.emit(name, METADATA)
-                            self.metadataServer.publishLayerMetadata(layer, wms)
-                            self.stepFinished.emit(name, METADATA)
-                        else:
-                            self.metadataServer.logError(self.tr("Layer '%s' has invalid metadata. Metadata was not published") % layer.name())
-                    except:                    
-                        errors.append(traceback.format_exc())
-                else:
-                    self.stepSkipped.emit(name, METADATA)
-
-                if self.geodataServer is not None:
-                    w, e = self.geodataServer.loggedInfo()
-                    warnings.extend(w)
-                    errors.extend(e)
-                if self.metadataServer is not None:
-                    w, e = self.metadataServer.loggedInfo()
-                    warnings.extend(w)
-                    errors.extend(e)
-                self.results[name] = (set(warnings), set(errors))
+                        signal, name, value = events.get(timeout=0.2)
+                    except queue.Empty:
+                        continue
+                    if signal is _LAYER_DONE:
+                        done += 1
+                        uploads.pop(name, None)
+                        self._publishPendingMetadata(force=False)
+                    elif signal is _UPLOAD_PROGRESS:
+                        uploads[name] = value
+                    else:
+                        signal.emit(name, value)
+                        continue
+                    self.setProgress((done + sum(uploads.values())) * 100 / len(futures))
+            finally:
+                executor.shutdown(wait=True)
+            self._publishPendingMetadata(force=True)
 
             if self.geodataServer is not None:
                 self.stepStarted.emit(None, GROUPS)
@@ -183,7 +159,7 @@ class PublishTask(QgsTask):
                     #TODO: figure out where to put a warning or error message for this
                     pass
                 finally:
-                    self.geodataServer.closePublishing()
+                    self._closePublishing()
                     self.stepFinished.emit(None, GROUPS)
             else:
                 self.stepSkipped.emit(None, GROUPS)
@@ -193,6 +169,152 @@ class PublishTask(QgsTask):
             self.exceptiontype, _, _ = sys.exc_info()
             self.exception = traceback.format_exc()
             return False
+        finally:
+            # cancelled or failed runs must also release the server state
+            try:
+                self._closePublishing()
+            except:
+                QgsMessageLog.logMessage(traceback.format_exc(), 'GeoCat Bridge', level=Qgis.Warning)
+            stats = credentialsCacheStats()
+            QgsMessageLog.logMessage("Credentials cache: %i hits, %i misses" % (stats["hits"], stats["misses"]),
+                                     'GeoCat Bridge', level=Qgis.Info)
+
+    def _closePublishing(self):
+        if self._publishingOpen:
+            self._publishingOpen = False
+            self.geodataServer.closePublishing()
+
+    def _publishLayer(self, name, layer, events):
+        warnings, errors, notes = [], [], []
+        servers = [s for s in [self.geodataServer, self.metadataServer] if s is not None]
+        def _uploadProgress(sent, total):
+            # an upload only accounts for part of the layer work
+            events.put((_UPLOAD_PROGRESS, name, 0.9 * sent / max(total, 1)))
+        for server in servers:
+            server.setUploadProgressCallback(_uploadProgress)
+            server.setCancelCallback(self.isCanceled)
+        try:
+            self._publishLayerSteps(name, layer, warnings, errors, notes,
+                                    lambda signal, category: events.put((signal, name, category)))
+        except:
+            errors.append(traceback.format_exc())
+        finally:
+            for server in servers:
+                server.setUploadProgressCallback(None)
+                server.setCancelCallback(None)
+            self.results[name] = (set(warnings), set(errors), notes)
+            events.put((_LAYER_DONE, name, None))
+
+    def _publishLayerSteps(self, name, layer, warnings, errors, notes, emit):
+        DONOTALLOW = 0
+        ALLOW = 1
+        ALLOWONLYDATA = 2
+        
+        allowWithoutMetadata = ALLOW #pluginSetting("allowWithoutMetadata")
+
+        if self.isCanceled():
+            return
+        with qgisLock():
+            warnings.extend(self.validateLayer(layer))
+            validates, _ = QgsNativeMetadataValidator().validate(layer.metadata())
+        validates = True
+        if self.geodataServer is not None:
+            self.geodataServer.resetLog()
+            try:
+                emit(self.stepStarted, SYMBOLOGY)
+                self.geodataServer.publishStyle(layer)
+                emit(self.stepFinished, SYMBOLOGY)
+            except:
+                emit(self.stepFinished, SYMBOLOGY)
+                errors.append(traceback.format_exc())
+            try:
+                if self.onlySymbology:
+                    emit(self.stepSkipped, DATA)
+                elif not self.isCanceled():
+                    emit(self.stepStarted, DATA)
+                    if validates or allowWithoutMetadata in [ALLOW, ALLOWONLYDATA]:
+                        fields = None
+                        if layer.type() == layer.VectorLayer:
+                            fields = [name for name, publish in self.fields[layer].items() if publish]                            
+                        self.geodataServer.publishLayer(layer, fields)
+                        if self.metadataServer is not None:
+                            metadataUuid = uuidForLayer(layer)
+                            url = self.metadataServer.metadataUrl(metadataUuid)
+                            self.geodataServer.setLayerMetadataLink(name, url)
+                    else:
+                        self.geodataServer.logError(self.tr("Layer '%s' has invalid metadata. Layer was not published") % layer.name())
+                    emit(self.stepFinished, DATA)
+            except:
+                emit(self.stepFinished, DATA)
+                errors.append(traceback.format_exc())
+        else:
+            emit(self.stepSkipped, SYMBOLOGY)
+            emit(self.stepSkipped, DATA)
+
+        if self.metadataServer is not None:
+            self.metadataServer.resetLog()
+            try:
+                if self.isCanceled():
+                    pass
+                elif validates or allowWithoutMetadata == ALLOW:
+                    if self.geodataServer is not None:
+                        wms = self.geodataServer.layerWmsUrl(layer.name())
+                    else:
+                        wms = None
+                    with qgisLock():
+                        self.autofillMetadata(layer)
+                    emit(self.stepStarted, METADATA)
+                    if self.metadataServer.metadataBatchSize() > 1:
+                        # the record is published later, along with others
+                        mef = self.metadataServer.layerMetadataMef(layer, wms)
+                        if mef is None:
+                            emit(self.stepFinished, METADATA)
+                        else:
+                            with self._pendingMetadataLock:
+                                self._pendingMetadata[name] = (uuidForLayer(layer), mef)
+                    else:
+                        self.metadataServer.publishLayerMetadata(layer, wms)
+                        emit(self.stepFinished, METADATA)
+                else:
+                    self.metadataServer.logError(self.tr("Layer '%s' has invalid metadata. Metadata was not published") % layer.name())
+            except:                    
+                errors.append(traceback.format_exc())
+        else:
+            emit(self.stepSkipped, METADATA)
+
+        if self.geodataServer is not None:
+            w, e = self.geodataServer.loggedInfo()
+            warnings.extend(w)
+            errors.extend(e)
+            notes.extend(self.geodataServer.loggedNotes())
+        if self.metadataServer is not None:
+            w, e = self.metadataServer.loggedInfo()
+            warnings.extend(w)
+            errors.extend(e)
+            notes.extend(self.metadataServer.loggedNotes())
+
+    def _publishPendingMetadata(self, force):
+        # Metadata records are sent to the catalog in batches. Records of
+        # layers that failed are added to the errors of those layers
+        size = self.metadataServer.metadataBatchSize() if self.metadataServer is not None else 1
+        while not self.isCanceled():
+            with self._pendingMetadataLock:
+                # only layers that are done have their results available
+                names = [name for name in self.layers 
+                         if name in self._pendingMetadata and name in self.results]
+                if not names or (len(names) < size and not force):
+                    return
+                batch = [(name, self._pendingMetadata.pop(name)) for name in names[:size]]
+            records = {uuid: mef for _, (uuid, mef) in batch}
+            try:
+                failed = self.metadataServer.publishMetadataBatch(records)
+            except:
+                error = traceback.format_exc()
+                failed = {uuid: error for uuid in records}
+            for name, (uuid, _) in batch:
+                if uuid in failed:
+                    self.results[name][1].add(failed[uuid])
+                self.stepFinished.emit(name, METADATA)
 
     def validateLayer(self, layer):
         warnings = []
@@ -244,6 +366,7 @@ class ExportTask(QgsTask):
         self.exportMetadata = exportMetadata
         self.exportSymbology = exportSymbology
         self.fields = fields
+        self.summary = None
 
     def layerFromName(self, name):
         layers = self.publishableLayers()
@@ -259,41 +382,141 @@ class ExportTask(QgsTask):
     def run(self):
         try:
             os.makedirs(self.folder, exist_ok=True)
-            for i, name in enumerate(self.layers):
-                if self.isCanceled():
-                    return False
-                self.setProgress(i * 100 / len(self.layers))                      
-                layer = self.layerFromName(name)
-                if self.exportSymbology:
-                    styleFilename = os.path.join(self.folder, layer.name() + "_style.zip")                    
-                    self.stepStarted.emit(name, SYMBOLOGY)
-                    saveLayerStyleAsZippedSld(layer, styleFilename)                    
-                    self.stepFinished.emit(name, SYMBOLOGY)
-                else:
-                    self.stepSkipped.emit(name, SYMBOLOGY)
-                if self.exportData:
-                    ext = ".gpkg" if layer.type() == layer.VectorLayer else ".tif"
-                    layerFilename = os.path.join(self.folder, layer.name() + ext)
-                    self.stepStarted.emit(name, DATA)
-                    exportLayer(layer, self.fields, log=self, force=True, path=layerFilename)
-                    self.stepFinished.emit(name, DATA)
-                else:
-                    self.stepSkipped.emit(name, DATA)
-                if self.exportMetadata:
-                    metadataFilename = os.path.join(self.folder, layer.name() + "_metadata.zip")
-                    self.stepStarted.emit(name, METADATA)
-                    saveMetadata(layer, metadataFilename)
-                    self.stepFinished.emit(name, METADATA)
-                else:
-                    self.stepSkipped.emit(name, METADATA)
-
+            start = time.time()
+            # Exports are CPU and disk bound, so one worker per core. Each
+            # worker gets its own clone of the layer, since QGIS layer objects
+            # must not be used from several threads at once
+            events = queue.Queue()
+            executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+            written = 0
+            try:
+                futures = []
+                for name in self.layers:
+                    layer = self.layerFromName(name)
+                    fields = None
+                    if layer.type() == layer.VectorLayer:
+                        fields = [f for f, publish in self.fields[layer].items() if publish]
+                    with qgisLock():
+                        clone = layer.clone()
+                    futures.append(executor.submit(self._exportLayer, name, layer, clone, fields, events))
+                done = 0
+                while done < len(futures):
+                    if self.isCanceled():
+                        for future in futures:
+                            future.cancel()
+                        return False
+                    try:
+                        signal, name, value = events.get(timeout=0.2)
+                    except queue.Empty:
+                        continue
+                    if signal is _LAYER_DONE:
+                        done += 1
+                        self.setProgress(done * 100 / len(futures))
+                    else:
+                        signal.emit(name, value)
+                for future in futures:
+                    written += future.result()
+            finally:
+                executor.shutdown(wait=True)
+            elapsed = max(time.time() - start, 0.001)
+            self.summary = (self.tr("%i layers exported in %.1f s (%.1f MB/s, %.1f layers/min)") 
+                            % (len(self.layers), elapsed, written / elapsed / 1024 / 1024, 
+                               len(self.layers) * 60 / elapsed))
+            self.logInfo(self.summary)
             return True
         except Exception as e:
             self.exception = traceback.format_exc()
             return False
 
+    def _exportLayer(self, name, layer, clone, fields, events):
+        written = []
+        def _emit(signal, category):
+            events.put((signal, name, category))
+        try:
+            if self.isCanceled():
+                return 0
+            if self.exportSymbology:
+                styleFilename = os.path.join(self.folder, layer.name() + "_style.zip")                    
+                _emit(self.stepStarted, SYMBOLOGY)
+                saveLayerStyleAsZippedSld(clone, styleFilename)                    
+                written.append(styleFilename)
+                _emit(self.stepFinished, SYMBOLOGY)
+            else:
+                _emit(self.stepSkipped, SYMBOLOGY)
+            if self.exportData:
+                ext = ".gpkg" if layer.type() == layer.VectorLayer else ".tif"
+                layerFilename = os.path.join(self.folder, layer.name() + ext)
+                _emit(self.stepStarted, DATA)
+                exportLayer(clone, fields, log=self, force=True, path=layerFilename)
+                written.append(layerFilename)
+                _emit(self.stepFinished, DATA)
+            else:
+                _emit(self.stepSkipped, DATA)
+            if self.exportMetadata:
+                metadataFilename = os.path.join(self.folder, layer.name() + "_metadata.zip")
+                _emit(self.stepStarted, METADATA)
+                saveMetadata(clone, metadataFilename)
+                written.append(metadataFilename)
+                _emit(self.stepFinished, METADATA)
+            else:
+                _emit(self.stepSkipped, METADATA)
+            return sum(os.path.getsize(f) for f in written if os.path.exists(f))
+        except:
+            # any failure stops the whole export, as it did when layers were
+            # exported one after the other
+            self.exception = traceback.format_exc()
+            self.cancel()
+            raise
+        finally:
+            events.put((_LAYER_DONE, name, None))
+
     def logInfo(self, text):
         QgsMessageLog.logMessage(text, 'GeoCat Bridge', level=Qgis.Info)
 
     def logWarning(self, text):
         QgsMessageLog.logMessage(text, 'GeoCat Bridge', level=Qgis.Warning)
+
+
+class PublicationStatusTask(QgsTask):
+
+    STATUS_BATCH_SIZE = 100
+
+    serverChecked = pyqtSignal(int, bool)
+    layerChecked = pyqtSignal(int, str, bool)
+
+    def __init__(self, geodataServer, metadataServer, uuids):
+        super().__init__("Check publication status", QgsTask.CanCancel)
+        self.geodataServer = geodataServer
+        self.metadataServer = metadataServer
+        self.uuids = uuids
+
+    def run(self):
+        if self.geodataServer is not None:
+            self._checkServer(DATA, self.geodataServer, self._checkData)
+        if self.metadataServer is not None and not self.isCanceled():
+            self._checkServer(METADATA, self.metadataServer, self._checkMetadata)
+        return not self.isCanceled()
+
+    def _checkServer(self, category, server, check):
+        try:
+            available = server.testConnection()
+            self.serverChecked.emit(category, available)
+            if available:
+                check()
+        except Exception as e:
+            QgsMessageLog.logMessage(traceback.format_exc(), 'GeoCat Bridge', level=Qgis.Warning)
+
+    def _checkData(self):
+        published = self.geodataServer.layerNames()
+        for name in self.uuids:
+            self.layerChecked.emit(DATA, name, name in published)
+
+    def _checkMetadata(self):
+        names = list(self.uuids.keys())
+        for i in range(0, len(names), self.STATUS_BATCH_SIZE):
+            if self.isCanceled():
+                return
+            batch = names[i:i + self.STATUS_BATCH_SIZE]
+            existing = self.metadataServer.existingMetadata([self.uuids[name] for name in batch])
+            for name in batch:
+                self.layerChecked.emit(METADATA, name, self.uuids[name] in existing)
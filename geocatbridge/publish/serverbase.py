@@ -1,6 +1,16 @@
+import io
+import os
 import requests
 import json
+import threading
+import time
+import uuid
+from zipfile import ZipFile
 
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+from qgis.PyQt.QtCore import QSettings, QCoreApplication
 from qgis.core import (
     QgsMessageLog,
     Qgis,
@@ -8,31 +18,229 @@ from qgis.core import (
     QgsApplication
 )
 
+POOL_SIZE_SETTING = "geocatbridge/ConnectionPoolSize"
+DEFAULT_POOL_SIZE = 10
+CONCURRENCY_SETTING = "geocatbridge/MaxConcurrentLayers/%s"
+DEFAULT_CONCURRENCY = 4
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_RETRIES = 5
+RETRY_DELAY = 2
+ZIP64_THRESHOLD = 2 ** 31
+
+class _ChunkSink(io.RawIOBase):
+
+    # write-only stream collecting what is written to it, so a zip file can
+    # be produced piece by piece without a file on disk
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return b"".join(chunks)
+
+
+def connectionPoolSize():
+    try:
+        return max(1, int(QSettings().value(POOL_SIZE_SETTING, DEFAULT_POOL_SIZE)))
+    except (TypeError, ValueError):
+        return DEFAULT_POOL_SIZE
+
+def createSession(poolSize=None):
+    poolSize = poolSize or connectionPoolSize()
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+_credentials = {}
+_credentialsLock = threading.RLock()
+_credentialsStats = {"hits": 0, "misses": 0}
+_authManagerConnected = False
+
+def watchAuthManager():
+    # must be called from the main thread, so the signals are delivered
+    # through a receiver that lives as long as the plugin
+    global _authManagerConnected
+    if not _authManagerConnected:
+        authManager = QgsApplication.authManager()
+        authManager.authDatabaseChanged.connect(invalidateCredentialsCache)
+        authManager.authDatabaseEraseRequested.connect(invalidateCredentialsCache)
+        _authManagerConnected = True
+
+def unwatchAuthManager():
+    global _authManagerConnected
+    if _authManagerConnected:
+        authManager = QgsApplication.authManager()
+        authManager.authDatabaseChanged.disconnect(invalidateCredentialsCache)
+        authManager.authDatabaseEraseRequested.disconnect(invalidateCredentialsCache)
+        _authManagerConnected = False
+    invalidateCredentialsCache()
+
+def invalidateCredentialsCache(authid=None):
+    with _credentialsLock:
+        if authid is None:
+            _credentials.clear()
+        else:
+            _credentials.pop(authid, None)
+
+def credentialsCacheStats():
+    with _credentialsLock:
+        return dict(_credentialsStats)
+
+def credentialsForAuthid(authid):
+    with _credentialsLock:
+        if authid in _credentials:
+            _credentialsStats["hits"] += 1
+            return _credentials[authid]
+        _credentialsStats["misses"] += 1
+        authConfig = QgsAuthMethodConfig()
+        loaded = QgsApplication.authManager().loadAuthenticationConfig(authid, authConfig, True)
+        credentials = authConfig.config('username'), authConfig.config('password')
+        if loaded:
+            _credentials[authid] = credentials
+        return credentials
+
 class ServerBase():
 
     def __init__(self):
-        self._warnings = []
-        self._errors = []
+        self._local = threading.local()
         self._username = None
         self._password = None
+        self._session = None
+        self._sessionLock = threading.Lock()
 
     def logInfo(self, text):
         QgsMessageLog.logMessage(text, 'GeoCat Bridge', level=Qgis.Info)
 
+    def logNote(self, text):
+        # informative messages that are also shown in the publish report
+        QgsMessageLog.logMessage(text, 'GeoCat Bridge', level=Qgis.Info)
+        self._threadLocal().notes.append(text)
+
     def logWarning(self, text):
         QgsMessageLog.logMessage(text, 'GeoCat Bridge', level=Qgis.Warning)
-        self._warnings.append(text)
+        self._threadLocal().warnings.append(text)
 
     def logError(self, text):
         QgsMessageLog.logMessage(text, 'GeoCat Bridge', level=Qgis.Critical)
-        self._errors.append(text)
+        self._threadLocal().errors.append(text)
+
+    def _threadLocal(self):
+        # each publishing thread handles one layer at a time, so warnings,
+        # errors and upload progress are kept per thread to keep them
+        # attached to their layer
+        if not hasattr(self._local, "warnings"):
+            self.resetLog()
+            self._local.uploadProgress = None
+            self._local.cancelCallback = None
+        return self._local
 
     def resetLog(self):
-        self._warnings = []
-        self._errors = []
+        self._local.warnings = []
+        self._local.errors = []
+        self._local.notes = []
 
     def loggedInfo(self):
-        return self._warnings, self._errors
+        local = self._threadLocal()
+        return local.warnings, local.errors
+
+    def loggedNotes(self):
+        return self._threadLocal().notes
+
+    def setUploadProgressCallback(self, callback):
+        self._threadLocal().uploadProgress = callback
+
+    def _reportUploadProgress(self, sent, total):
+        callback = self._threadLocal().uploadProgress
+        if callback is not None:
+            callback(sent, total)
+
+    def setCancelCallback(self, callback):
+        # long running uploads and loads call it to stop as soon as the
+        # publishing task is cancelled
+        self._threadLocal().cancelCallback = callback
+
+    def cancelCallback(self):
+        return self._threadLocal().cancelCallback
+
+    def checkCanceled(self):
+        callback = self._threadLocal().cancelCallback
+        if callback is not None and callback():
+            raise Exception(QCoreApplication.translate("GeocatBridge", "Publishing was cancelled"))
+
+    def _fileChunks(self, filename):
+        total = os.path.getsize(filename)
+        sent = 0
+        with open(filename, "rb") as f:
+            while True:
+                self.checkCanceled()
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                self._reportUploadProgress(sent, total)
+                yield chunk
+
+    def fileBody(self, filename):
+        # a generator body is sent with chunked transfer encoding, so the
+        # file is never loaded in memory as a whole
+        return self._fileChunks(filename)
+
+    def zipChunks(self, filenames):
+        # the zip file is produced as it is sent, never written to disk
+        total = sum(os.path.getsize(f) for f in filenames)
+        sent = 0
+        sink = _ChunkSink()
+        with ZipFile(sink, "w") as z:
+            for filename in filenames:
+                size = os.path.getsize(filename)
+                with open(filename, "rb") as src:
+                    with z.open(os.path.basename(filename), "w", force_zip64=size >= ZIP64_THRESHOLD) as dest:
+                        while True:
+                            self.checkCanceled()
+                            chunk = src.read(UPLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            sent += len(chunk)
+                            self._reportUploadProgress(sent, total)
+                            yield sink.drain()
+        yield sink.drain()
+
+    def multipartZipBody(self, filenames, name, fieldname=None):
+        return self._multipartBody(self.zipChunks(filenames), name, fieldname)
+
+    def multipartFileBody(self, filename, fieldname=None):
+        return self._multipartBody(self._fileChunks(filename), os.path.basename(filename), fieldname)
+
+    def _multipartBody(self, chunks, name, fieldname=None):
+        boundary = uuid.uuid4().hex
+        prefix = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                  'Content-Type: application/octet-stream\r\n\r\n' % (boundary, fieldname or name, name))
+        suffix = '\r\n--%s--\r\n' % boundary
+        contentType = "multipart/form-data; boundary=%s" % boundary
+        def _body():
+            yield prefix.encode("utf-8")
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+            yield suffix.encode("utf-8")
+        return _body(), contentType
+
+    def maxConcurrency(self):
+        try:
+            return max(1, int(QSettings().value(CONCURRENCY_SETTING % self.name, DEFAULT_CONCURRENCY)))
+        except (TypeError, ValueError):
+            return DEFAULT_CONCURRENCY
 
     def setBasicAuthCredentials(self, username, password):
         self._username = username
@@ -40,19 +248,27 @@ class ServerBase():
 
     def getCredentials(self):
         if self._username is None or self._password is None:
-            authConfig = QgsAuthMethodConfig()
-            QgsApplication.authManager().loadAuthenticationConfig(self.authid, authConfig, True)
-            username = authConfig.config('username')
-            password = authConfig.config('password')
-            return username, password
+            return credentialsForAuthid(self.authid)
         else:
             return self._username, self._password
 
+    def session(self):
+        with self._sessionLock:
+            if self._session is None:
+                self._session = createSession()
+            return self._session
+
+    def closeSession(self):
+        with self._sessionLock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
     def request(self, url, data=None, method="get", headers=None, files=None):
         headers = headers or {}
         files = files or {}
         username, password = self.getCredentials()
-        req_method = getattr(requests, method.lower())
+        req_method = getattr(self.session(), method.lower())
         if isinstance(data, dict):
             data = json.dumps(data)
             headers["content-type"] = "application/json"
@@ -61,6 +277,26 @@ class ServerBase():
         r.raise_for_status()
         return r
 
+    def _isTransientError(self, e):
+        if isinstance(e, (ConnectionError, Timeout)):
+            return True
+        return isinstance(e, HTTPError) and e.response is not None and e.response.status_code >= 500
+
+    def withRetries(self, func, retries=MAX_RETRIES, delay=RETRY_DELAY):
+        # func is called again from scratch, so it must build a new request
+        # body on each call
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                if attempt >= retries or not self._isTransientError(e):
+                    raise
+                wait = delay * 2 ** attempt
+                self.logInfo("Request failed (%s). Retrying in %i seconds" % (e, wait))
+                time.sleep(wait)
+                attempt += 1
+
     def addOGCServers(self):
         pass
 
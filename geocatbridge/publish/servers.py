@@ -46,7 +46,7 @@ def addServer(server):
     _updateStoredServers()
 
 def removeServer(name):
-    del _servers[name]
+    _servers.pop(name).closeSession()
     _updateStoredServers()
 
 def geodataServers():
@@ -0,0 +1,100 @@
+'''
+Unit tests for the encoding of values and geometries that are sent to
+PostGIS using COPY.
+
+These tests need the QGIS Python libraries and psycopg2. To run them, use
+the following code from the QGIS Python console:
+
+>>> from geocatbridge.tests.postgistests import run_tests
+>>> run_tests()
+
+'''
+
+import struct
+import unittest
+
+from qgis.PyQt.QtCore import QVariant, QDate, QDateTime, QTime, QByteArray
+
+from geocatbridge.publish.postgis import _copyValue, _ewkbHex, WKB_SRID_FLAG
+
+
+class _Geometry():
+
+    def __init__(self, wkb):
+        self.wkb = wkb
+
+    def asWkb(self):
+        return QByteArray(self.wkb)
+
+
+class CopyValueTest(unittest.TestCase):
+
+    def testNulls(self):
+        self.assertEqual(_copyValue(None), "\\N")
+        self.assertEqual(_copyValue(QVariant()), "\\N")
+        self.assertEqual(_copyValue(QDate()), "\\N")
+        self.assertEqual(_copyValue(QDateTime()), "\\N")
+
+    def testEscaping(self):
+        self.assertEqual(_copyValue("a\tb\nc\rd"), "a\\tb\\nc\\rd")
+        self.assertEqual(_copyValue("back\\slash"), "back\\\\slash")
+        self.assertEqual(_copyValue("\\N"), "\\\\N")
+
+    def testNumbersAndBooleans(self):
+        self.assertEqual(_copyValue(3), "3")
+        self.assertEqual(_copyValue(2.5), "2.5")
+        self.assertEqual(_copyValue(True), "t")
+        self.assertEqual(_copyValue(False), "f")
+
+    def testDates(self):
+        self.assertEqual(_copyValue(QDate(2020, 1, 31)), "2020-01-31")
+        self.assertEqual(_copyValue(QTime(10, 5, 3)), "10:05:03")
+        self.assertEqual(_copyValue(QDateTime(QDate(2020, 1, 31), QTime(10, 5, 3))), "2020-01-31T10:05:03")
+
+    def testBytea(self):
+        self.assertEqual(_copyValue(QByteArray(b"\x00\xff")), "\\\\x00ff")
+        self.assertEqual(_copyValue(b"ab"), "\\\\x6162")
+
+    def testLists(self):
+        self.assertEqual(_copyValue(["a", "b"]), '{"a","b"}')
+        self.assertEqual(_copyValue([1, None]), '{"1",NULL}')
+        self.assertEqual(_copyValue(['say "hi"', "a\\b"]), '{"say \\\\"hi\\\\"","a\\\\\\\\b"}')
+        self.assertEqual(_copyValue([]), "{}")
+
+    def testMaps(self):
+        self.assertEqual(_copyValue({"a": 1, "b": None}), '{"a": 1, "b": null}')
+        self.assertEqual(_copyValue({"a": "x\ty"}), '{"a": "x\\\\ty"}')
+
+
+class EwkbTest(unittest.TestCase):
+
+    def testLittleEndian(self):
+        wkb = struct.pack("<BIdd", 1, 1, 1.0, 2.0)
+        expected = b"\x01" + struct.pack("<II", 1 | WKB_SRID_FLAG, 4326) + wkb[5:]
+        self.assertEqual(_ewkbHex(_Geometry(wkb), 4326), expected.hex())
+
+    def testBigEndian(self):
+        wkb = struct.pack(">BIdd", 0, 1, 1.0, 2.0)
+        expected = b"\x00" + struct.pack(">II", 1 | WKB_SRID_FLAG, 3857) + wkb[5:]
+        self.assertEqual(_ewkbHex(_Geometry(wkb), 3857), expected.hex())
+
+    def testIsoZ(self):
+        wkb = struct.pack("<BIddd", 1, 1001, 1.0, 2.0, 3.0)
+        expected = b"\x01" + struct.pack("<II", 1001 | WKB_SRID_FLAG, 4326) + wkb[5:]
+        self.assertEqual(_ewkbHex(_Geometry(wkb), 4326), expected.hex())
+
+    def testNoSrid(self):
+        wkb = struct.pack("<BIdd", 1, 1, 1.0, 2.0)
+        self.assertEqual(_ewkbHex(_Geometry(wkb), 0), wkb.hex())
+
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([loader.loadTestsFromTestCase(CopyValueTest),
+                               loader.loadTestsFromTestCase(EwkbTest)])
+
+def run_tests():
+    unittest.TextTestRunner(verbosity=2).run(suite())
+
+if __name__ == "__main__":
+    run_tests()
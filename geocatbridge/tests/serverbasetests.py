@@ -0,0 +1,58 @@
+'''
+Unit tests for the cache of credentials resolved from QGIS auth configs.
+
+These tests need the QGIS Python libraries. To run them, use the following
+code from the QGIS Python console:
+
+>>> from geocatbridge.tests.serverbasetests import run_tests
+>>> run_tests()
+
+'''
+
+import unittest
+
+from geocatbridge.publish import serverbase
+from geocatbridge.publish.serverbase import (credentialsForAuthid, credentialsCacheStats, 
+                                             invalidateCredentialsCache)
+
+
+class CredentialsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        invalidateCredentialsCache()
+
+    def tearDown(self):
+        invalidateCredentialsCache()
+
+    def testHit(self):
+        serverbase._credentials["cachedid"] = ("user", "password")
+        before = credentialsCacheStats()
+        self.assertEqual(credentialsForAuthid("cachedid"), ("user", "password"))
+        after = credentialsCacheStats()
+        self.assertEqual(after["hits"], before["hits"] + 1)
+        self.assertEqual(after["misses"], before["misses"])
+
+    def testMissIsNotCachedForUnknownConfig(self):
+        before = credentialsCacheStats()
+        credentialsForAuthid("unknownid")
+        credentialsForAuthid("unknownid")
+        after = credentialsCacheStats()
+        self.assertEqual(after["misses"], before["misses"] + 2)
+        self.assertEqual(after["hits"], before["hits"])
+
+    def testInvalidation(self):
+        serverbase._credentials["cachedid"] = ("user", "password")
+        invalidateCredentialsCache("cachedid")
+        before = credentialsCacheStats()
+        credentialsForAuthid("cachedid")
+        self.assertEqual(credentialsCacheStats()["misses"], before["misses"] + 1)
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(CredentialsCacheTest)
+
+def run_tests():
+    unittest.TextTestRunner(verbosity=2).run(suite())
+
+if __name__ == "__main__":
+    run_tests()
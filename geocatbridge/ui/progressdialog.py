@@ -2,7 +2,7 @@ import os
 
 from qgis.PyQt import uic
 
-from qgis.PyQt.QtCore import Qt, QCoreApplication
+from qgis.PyQt.QtCore import Qt, pyqtSignal
 from qgis.PyQt.QtGui import QBrush, QIcon
 from qgis.PyQt.QtWidgets import QTreeWidgetItem
 
@@ -22,12 +22,24 @@ CHECK_ICON = QIcon(iconPath("checkmark.png"))
 
 class ProgressDialog(BASE, WIDGET):
 
+    cancelRequested = pyqtSignal()
+
     def __init__(self, layers, parent=None):
         super(ProgressDialog, self).__init__(parent)
         self.setupUi(self)
         self.layers = layers
+        self.buttonBox.rejected.connect(self.reject)
         self.populateTree()
 
+    def reject(self):
+        # the dialog stays open until the task has actually stopped
+        self.buttonBox.setEnabled(False)
+        self.setWindowTitle(self.tr("Cancelling..."))
+        self.cancelRequested.emit()
+
+    def setProgress(self, value):
+        self.progressBar.setValue(int(value))
+
     def populateTree(self):
         for layer in self.layers:
             item = QTreeWidgetItem()
@@ -50,7 +62,6 @@ class ProgressDialog(BASE, WIDGET):
         item.setText(0, "Create layer groups")
         item.setIcon(0, GROUPS_ICON)
         self.treeWidget.addTopLevelItem(item)
-        QCoreApplication.processEvents()
 
     def setFinished(self, layer, category):
         if category == GROUPS:
@@ -68,7 +79,6 @@ class ProgressDialog(BASE, WIDGET):
             item.setForeground(1, QBrush(Qt.blue))
             item.setIcon(1, CHECK_ICON)
             #item.setExpanded(False)
-        QCoreApplication.processEvents()
 
     def setSkipped(self, layer, category):
         if category == GROUPS:
@@ -86,7 +96,6 @@ class ProgressDialog(BASE, WIDGET):
             item.setForeground(1, QBrush(Qt.blue))
             item.setIcon(1, CHECK_ICON)
             #item.setExpanded(False)
-        QCoreApplication.processEvents()
 
     def setInProgress(self, layer, category):
         if category == GROUPS:
@@ -100,5 +109,4 @@ class ProgressDialog(BASE, WIDGET):
         self.treeWidget.scrollToItem(subitem)
         subitem.setText(1, "In progress...")
         subitem.setBackground(0, QBrush(Qt.cyan))
-        subitem.setBackground(1, QBrush(Qt.cyan))
-        QCoreApplication.processEvents()
\ No newline at end of file
+        subitem.setBackground(1, QBrush(Qt.cyan))
\ No newline at end of file
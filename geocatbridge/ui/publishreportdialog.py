@@ -39,7 +39,7 @@ class PublishReportDialog(BASE, WIDGET):
         self.labelPublishMetadata.setText("ON" if metadataServer is not None else "OFF")
         self.tableWidget.setRowCount(len(results))
         for i, name in enumerate(results.keys()):
-            warnings, errors = results[name]
+            warnings, errors, notes = results[name]
             item = QTableWidgetItem(name)
             item.setFlags(item.flags() ^ Qt.ItemIsEditable)
             self.tableWidget.setItem(i, 0, item)
@@ -72,10 +72,12 @@ class PublishReportDialog(BASE, WIDGET):
             self.tableWidget.setCellWidget(i, 4, widget)
 
     def openDetails(self, name):
-        warnings, errors = self.results[name]
+        warnings, errors, notes = self.results[name]
         w = "<br><br>".join(warnings)
         e = "<br><br>".join(errors)
         txt = "<p><b>%s</b></p>%s<p><b>%s</b></p>%s" % (self.tr("Warnings:"), w, self.tr("Errors:"), e)
+        if notes:
+            txt = "<p><b>%s</b></p>%s%s" % (self.tr("Notes:"), "<br><br>".join(notes), txt)
         txt = txt.replace("\n","<br>") # make output easier to read
         dlg = QgsMessageOutput.createMessageOutput()
         dlg.setTitle(self.tr("Wanings / Errors"))
@@ -39,19 +39,20 @@ from qgis.core import (
     QgsProject,
     Qgis,
     QgsApplication,
-    QgsRectangle
+    QgsRectangle,
+    QgsTask
 )
 from qgis.gui import QgsMessageBar, QgsMetadataWidget
 from qgis.utils import iface
 
 from geocatbridge.utils.gui import execute
 from geocatbridge.publish.geonetwork import GeonetworkServer
-from geocatbridge.publish.publishtask import PublishTask, ExportTask
+from geocatbridge.publish.publishtask import PublishTask, ExportTask, PublicationStatusTask
 from geocatbridge.publish.servers import geodataServers, metadataServers
 from geocatbridge.publish.metadata import uuidForLayer, loadMetadataFromIsoXml
 from geocatbridge.ui.metadatadialog import MetadataDialog
 from geocatbridge.ui.publishreportdialog import PublishReportDialog
-from geocatbridge.ui.progressdialog import ProgressDialog
+from geocatbridge.ui.progressdialog import ProgressDialog, DATA, METADATA
 
 def iconPath(icon):
     return os.path.join(os.path.dirname(os.path.dirname(__file__)), "icons", icon)
@@ -76,6 +77,10 @@ class PublishWidget(BASE, WIDGET):
         self.currentRow = None
         self.currentLayer = None
         self.parent = parent
+        self.statusTask = None
+        self.statusTaskPending = (False, False)
+        self.publishTask = None
+        self.serverAvailable = {DATA: True, METADATA: True}
 
         self.fieldsToPublish = {}
         self.metadata = {}
@@ -318,25 +323,6 @@ class PublishWidget(BASE, WIDGET):
         self.comboGeodataServer.currentIndexChanged.connect(self.geodataServerChanged)
         self.comboMetadataServer.currentIndexChanged.connect(self.metadataServerChanged)
 
-    def isMetadataOnServer(self, layer):
-        try:
-            server = metadataServers()[self.comboMetadataServer.currentText()]
-            uuid = uuidForLayer(self.layerFromName(layer))
-            return server.metadataExists(uuid)
-        except KeyError:
-            return False
-        except:
-            return False
-
-    def isDataOnServer(self, layer):
-        try:
-            server = geodataServers()[self.comboGeodataServer.currentText()] 
-            return server.layerExists(layer)            
-        except KeyError:            
-            return False
-        except Exception as e:
-            return False
-
     def importMetadata(self):
         if self.currentLayer is None:
             return
@@ -420,51 +406,68 @@ class PublishWidget(BASE, WIDGET):
                 widget.setDataPublished(server)
 
     def updateLayersPublicationStatus(self, data=True, metadata=True):
-        canPublish = True
-        if data:
+        # Status is checked by a background task with one bulk query per
+        # server. Icons are filled in as results arrive
+        if self.statusTask is not None:
+            # checks that the replaced task had not completed are done again
+            data = data or self.statusTaskPending[0]
+            metadata = metadata or self.statusTaskPending[1]
             try:
-                dataServer = geodataServers()[self.comboGeodataServer.currentText()]
-                if dataServer.testConnection():
-                    self.comboGeodataServer.setStyleSheet("QComboBox { }")
-                else:
-                    self.comboGeodataServer.setStyleSheet("QComboBox { border: 2px solid red; }")
-                    dataServer = None
-                    canPublish = False
-            except KeyError:
-                self.comboGeodataServer.setStyleSheet("QComboBox { }")
-                dataServer = None
-            
-        if metadata:
-            try:
-                metadataServer = metadataServers()[self.comboMetadataServer.currentText()]
-                if metadataServer.testConnection():
-                    self.comboMetadataServer.setStyleSheet("QComboBox { }")
-                else:
-                    self.comboMetadataServer.setStyleSheet("QComboBox { border: 2px solid red; }")
-                    metadataServer = None
-                    canPublish = False
-            except KeyError:
-                self.comboMetadataServer.setStyleSheet("QComboBox { }")
-                metadataServer = None
-
+                self.statusTask.cancel()
+            except RuntimeError:
+                pass # task already finished and deleted by the task manager
+            self.statusTask = None
+            self.statusTaskPending = (False, False)
+        dataServer = geodataServers().get(self.comboGeodataServer.currentText()) if data else None
+        metadataServer = metadataServers().get(self.comboMetadataServer.currentText()) if metadata else None
         for i in range(self.listLayers.count()):
             item = self.listLayers.item(i)
             widget = self.listLayers.itemWidget(item)
-            name = widget.name()
             if data:
-                server = None
-                if dataServer:
-                    self.isDataPublished[name] = self.isDataOnServer(name)
-                    server = dataServer if self.isDataPublished[name] else None
-                widget.setDataPublished(server)
+                self.isDataPublished[widget.name()] = False
+                widget.setDataPublished(None)
             if metadata:
-                server = None
-                if metadataServer:
-                    self.isMetadataPublished[name] = self.isMetadataOnServer(name)
-                    server = metadataServer if self.isMetadataPublished[name] else None
-                widget.setMetadataPublished(server)
+                self.isMetadataPublished[widget.name()] = False
+                widget.setMetadataPublished(None)
+        if data:
+            self.comboGeodataServer.setStyleSheet("QComboBox { }")
+            self.serverAvailable[DATA] = True
+        if metadata:
+            self.comboMetadataServer.setStyleSheet("QComboBox { }")
+            self.serverAvailable[METADATA] = True
+        self.updatePublishButtons()
+        if dataServer is None and metadataServer is None:
+            return
+        uuids = {layer.name(): uuidForLayer(layer) for layer in self.publishableLayers()}
+        self.statusTask = PublicationStatusTask(dataServer, metadataServer, uuids)
+        self.statusTaskPending = (data, metadata)
+        self.statusTask.serverChecked.connect(self.serverStatusChecked)
+        self.statusTask.layerChecked.connect(self.layerStatusChecked)
+        self.statusTask.taskCompleted.connect(self.statusTaskCompleted)
+        QgsApplication.taskManager().addTask(self.statusTask)
+
+    def serverStatusChecked(self, category, available):
+        if self.sender() is not self.statusTask:
+            return
+        combo = self.comboGeodataServer if category == DATA else self.comboMetadataServer
+        combo.setStyleSheet("QComboBox { }" if available else "QComboBox { border: 2px solid red; }")
+        self.serverAvailable[category] = available
+        self.updatePublishButtons()
+
+    def statusTaskCompleted(self):
+        if self.sender() is self.statusTask:
+            self.statusTaskPending = (False, False)
 
-        canPublish = canPublish and self.listLayers.count()
+    def layerStatusChecked(self, category, name, published):
+        if self.sender() is not self.statusTask:
+            return
+        if category == DATA:
+            self.updateLayerIsDataPublished(name, published)
+        else:
+            self.updateLayerIsMetadataPublished(name, published)
+
+    def updatePublishButtons(self):
+        canPublish = all(self.serverAvailable.values()) and bool(self.listLayers.count())
         self.btnPublish.setEnabled(canPublish)
         self.btnPublishOnBackground.setEnabled(canPublish)
 
@@ -523,22 +526,40 @@ class PublishWidget(BASE, WIDGET):
             task.stepStarted.connect(progressDialog.setInProgress)
             task.stepSkipped.connect(progressDialog.setSkipped)
             task.stepFinished.connect(progressDialog.setFinished)
+            task.progressChanged.connect(progressDialog.setProgress)
+            progressDialog.cancelRequested.connect(task.cancel)
+            def _statusChanged(status):
+                # connected before the task manager's own handler, so the
+                # dialog is closed before the publication report is shown
+                if status in [QgsTask.Complete, QgsTask.Terminated]:
+                    progressDialog.accept()
+            task.statusChanged.connect(_statusChanged)
+            task.taskCompleted.connect(lambda: self.publishTaskEnded(task))
+            task.taskTerminated.connect(lambda: self.publishTaskEnded(task))
+            self.publishTask = task
+            # only the Bridge dialog is blocked, QGIS stays usable meanwhile
+            progressDialog.setWindowModality(Qt.WindowModal)
             progressDialog.show()            
-            #task.progressChanged.connect(progress.setValue)
-            ret = execute(task.run)     
-            progressDialog.close()
-            #self.bar.clearWidgets()
-            task.finished(ret)
-            if task.exception is not None:
-                if task.exceptiontype == requests.exceptions.ConnectionError:
-                    QMessageBox.warning(self, self.tr("Error while publishing"), 
-                            self.tr("Connection error. Server unavailable.\nSee QGIS log for details"))
-                else:
-                    self.bar.clearWidgets()
-                    self.bar.pushMessage(self.tr("Error while publishing"), self.tr("See QGIS log for details"), level=Qgis.Warning, duration=5)
-                QgsMessageLog.logMessage(task.exception, 'GeoCat Bridge', level=Qgis.Critical)
-            if isinstance(task, PublishTask):
-                self.updateLayersPublicationStatus(task.geodataServer is not None, task.metadataServer is not None)
+            QgsApplication.taskManager().addTask(task)
+
+    def publishTaskEnded(self, task):
+        self.publishTask = None
+        if task.exception is not None:
+            if getattr(task, "exceptiontype", None) == requests.exceptions.ConnectionError:
+                QMessageBox.warning(self, self.tr("Error while publishing"), 
+                        self.tr("Connection error. Server unavailable.\nSee QGIS log for details"))
+            else:
+                self.bar.clearWidgets()
+                self.bar.pushMessage(self.tr("Error while publishing"), self.tr("See QGIS log for details"), level=Qgis.Warning, duration=5)
+            QgsMessageLog.logMessage(task.exception, 'GeoCat Bridge', level=Qgis.Critical)
+        elif task.isCanceled():
+            self.bar.clearWidgets()
+            self.bar.pushMessage("", self.tr("Publication was cancelled"), level=Qgis.Info, duration=5)
+        elif isinstance(task, ExportTask) and task.summary:
+            self.bar.clearWidgets()
+            self.bar.pushMessage("", task.summary, level=Qgis.Success, duration=10)
+        if isinstance(task, PublishTask):
+            self.updateLayersPublicationStatus(task.geodataServer is not None, task.metadataServer is not None)
 
     def publishOnBackground(self):
         if self.validateBeforePublication():
@@ -616,8 +637,9 @@ class PublishWidget(BASE, WIDGET):
                 metadataServer = None 
 
             onlySymbology = self.chkOnlySymbology.checkState() == Qt.Checked
+            incremental = self.chkOnlyChanges.checkState() == Qt.Checked
 
-            return PublishTask(toPublish, self.fieldsToPublish, onlySymbology, geodataServer, metadataServer, parent)
+            return PublishTask(toPublish, self.fieldsToPublish, onlySymbology, geodataServer, metadataServer, parent, incremental)
         else:
             return ExportTask(self.txtExportFolder.text(), toPublish, self.fieldsToPublish, self.chkExportData.isChecked(),
                                 self.chkExportMetadata.isChecked(), self.chkExportSymbology.isChecked())
@@ -57,6 +57,8 @@ class ServerConnectionsWidget(BASE, WIDGET):
         self.txtGeoserverName.textChanged.connect(self._setCurrentServerHasChanges)
         self.txtPostgisName.textChanged.connect(self._setCurrentServerHasChanges)
         self.txtGeoserverUrl.textChanged.connect(self._setCurrentServerHasChanges)
+        self.txtGeoserverLocalPath.textChanged.connect(self._setCurrentServerHasChanges)
+        self.txtGeoserverServerPath.textChanged.connect(self._setCurrentServerHasChanges)
         self.txtGeocatLiveName.textChanged.connect(self._setCurrentServerHasChanges)
         self.txtCswUrl.textChanged.connect(self._setCurrentServerHasChanges)
         self.txtPostgisServerAddress.textChanged.connect(self._setCurrentServerHasChanges)
@@ -106,6 +108,10 @@ class ServerConnectionsWidget(BASE, WIDGET):
 
     def geoserverDatastorageChanged(self):
         storage = self.comboGeoserverDataStorage.currentIndex()
+        shared = storage == GeoserverServer.SHARED_FOLDER
+        self.txtGeoserverLocalPath.setVisible(shared)
+        self.txtGeoserverServerPath.setVisible(shared)
+        self.labelGeoserverDatastore.setText(self.tr("Folder") if shared else self.tr("Datastore"))
         if storage == GeoserverServer.POSTGIS_MANAGED_BY_BRIDGE:
             self.populatePostgisComboWithPostgisServers()
             self.comboGeoserverDatabase.setVisible(True)
@@ -118,7 +124,11 @@ class ServerConnectionsWidget(BASE, WIDGET):
             self.labelGeoserverDatastore.setVisible(True)
             self.btnRefreshDatabases.setVisible(True)
             self.populatePostgisComboWithGeoserverPostgisServers()
-
+        elif shared:
+            self.comboGeoserverDatabase.setVisible(False)
+            self.btnAddDatastore.setVisible(False)
+            self.labelGeoserverDatastore.setVisible(True)
+            self.btnRefreshDatabases.setVisible(False)
         else:
             self.comboGeoserverDatabase.setVisible(False)
             self.btnAddDatastore.setVisible(False)
@@ -271,10 +281,14 @@ class ServerConnectionsWidget(BASE, WIDGET):
         postgisdb = None
         if storage in [GeoserverServer.POSTGIS_MANAGED_BY_BRIDGE, GeoserverServer.POSTGIS_MANAGED_BY_GEOSERVER]:            
             postgisdb = self.comboGeoserverDatabase.currentText()                
+        localPath = serverPath = ""
+        if storage == GeoserverServer.SHARED_FOLDER:
+            localPath = self.txtGeoserverLocalPath.text().strip()
+            serverPath = self.txtGeoserverServerPath.text().strip()
         
         if "" in [name, url]:
             return None
-        server = GeoserverServer(name, url, authid, storage, postgisdb)
+        server = GeoserverServer(name, url, authid, storage, postgisdb, localPath, serverPath)
         return server
 
     def createPostgisServer(self):
@@ -459,6 +473,8 @@ class ServerConnectionsWidget(BASE, WIDGET):
             self.geoserverDatastorageChanged()            
             if server.postgisdb is not None:
                 self.comboGeoserverDatabase.setCurrentText(server.postgisdb)
+            self.txtGeoserverLocalPath.setText(server.localPath)
+            self.txtGeoserverServerPath.setText(server.serverPath)
             self.comboGeoserverDataStorage.blockSignals(False)
         elif isinstance(server, MapserverServer):
             self.stackedWidget.setCurrentWidget(self.widgetMapserver)
@@ -0,0 +1,6 @@
+import threading
+
+_qgisLock = threading.RLock()
+
+def qgisLock():
+    return _qgisLock